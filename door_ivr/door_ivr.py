@@ -4,370 +4,1221 @@ init Lab door IVR AGI script
 """
 import abc
 import argparse
+import concurrent.futures
 import configparser
+import errno
+import json
+import pprint
 import re
+import sys
+import threading
 import time
 import typing
 
-import requests
-import requests.exceptions
-
 from pathlib import Path
 
-from asterisk.agi import AGI
+from asterisk.agi import AGI, AGIAppError, AGIError, AGIHangup, AGIInvalidCommand, AGIResultHangup, \
+    AGISIGPIPEHangup, AGIUnknownError, AGIUsageError, re_code
+
+import door_ivr_backend
+
+from door_ivr_assets import PromptCompositor, build_assets, get_asset_manifest, get_door_menu_prompts, \
+    get_prompt_compositor, get_sounds_path, localize_prompt, verify_assets
+from door_ivr_backend import DOOR_ACTION_RETRY_STATUS_CODES, DOOR_LOCKED, DOOR_UNLOCKED, BackendHTTPError, \
+    BackendRequestError, BackendUnavailableError, DoorActionPolicy, HTTPClientSession, get_auth_token_ttl, \
+    get_backend_executor, get_backend_timeout, get_circuit_breaker, get_door_action_policy, get_door_status_cache, \
+    get_http_session, start_door_status_subscription, submit_to_daemon_thread
+from door_ivr_caches import ChannelDebounce, OfflineAuthStore, auth_token_cache, configure_caches, doors_cache, \
+    get_offline_auth_store, session_bootstrap_missing, user_locale_cache
+from door_ivr_metrics import CallTimings, start_metrics_server, timed_stage
+from door_ivr_server import FASTAGI_DEFAULT_PORT, FastAGIServer
+
+if typing.TYPE_CHECKING:
+    # imported on first use only (see door_ivr_backend.get_http_session) - slow to import and every call started by
+    # Asterisk's AGI() is a new process
+    import requests
 
 
 ALLOWED_CODE_ENTERING_ATTEMPTS_COUNT = 3
 
 DIGITS = list(range(10))
 
+# limit of the digits collected by a single GET DATA - more than any pin or phone number
+MAX_INPUT_DIGITS = 32
+
+# pyst2's re_kv, but a value can be empty - GET DATA answers "200 result= (timeout)"
+# when no digit was pressed in time and "200 result=" when # was pressed right away
+AGI_RESULT_KV_RE = re.compile(r'(?P<key>\w+)=(?P<value>[^\s]*)\s*(?:\((?P<data>.*)\))*')
+
 # door actions
 DOOR_UNLOCK = 'unlock'
 DOOR_OPEN = 'open'
 DOOR_LOCK = 'lock'
 
+_MISSING = object()
+
+
+def build_doors_map(doors) -> typing.Dict[int, dict]:
+    """
+    Map the menu numbers 1-8 to doors, backwards compatible if not all doors have numbers.
+    """
+    available_numbers = set(range(1, 9))
+    free_numbers = iter(sorted(available_numbers - set(door.get('number', -1) for door in doors)))
+
+    doors_map = {
+        door.get('number') if door.get('number') in available_numbers else next(free_numbers): door
+        for door in doors
+    }
+
+    assert len(doors) == len(doors_map), 'There are door number duplicates!'
+    return doors_map
+
+
+def get_door_action_choices(doors_map: typing.Dict[int, dict]) -> typing.List[str]:
+    """
+    Return the menu choices - the numbers of the doors which can be opened and 9 for locking all doors.
+    """
+    return [
+        str(door_number) for door_number, door in doors_map.items()
+        if {DOOR_UNLOCK, DOOR_OPEN}.intersection(set(door['supported_actions']))
+    ] + ['9']
+
+
+def load_config(config_filename: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(config_filename)
+    return config
+
+
+def run_sync(coroutine: typing.Coroutine):
+    """
+    Run a coroutine of the call flow of a ``BlockingDoorManager`` to the end in the current thread and return its
+    result - all its I/O blocks, so it never suspends.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError(f'{coroutine!r} suspended - only the blocking I/O primitives can run in run_sync')
+
+
+class BackendLookups:
+    """
+    Look up the caller's auth token in the background and, once it is known, their locale and doors concurrently,
+    so the lookups overlap with answering the call and playing the greeting.
+
+    With an offline auth store (see ``OfflineAuthStore``) a lookup which misses the store's deadline or fails because
+    the backend is down (see ``AbstractDoorManager.is_backend_outage``) is answered from the store, while the request
+    keeps running in the background to update the store. Lookups the backend rejected are never answered from it.
+
+    The lookups only talk to the backend - all AGI commands stay in the call's flow. They run in the background
+    the way the door manager's I/O layer runs them (see ``AbstractDoorManager.spawn``).
+    """
+
+    def __init__(self, door_manager: 'AbstractDoorManager'):
+        self.door_manager = door_manager
+        self.offline_auth = get_offline_auth_store(door_manager.config)
+        self.offline_lookups: typing.List[str] = []  # the lookups answered from the offline auth store
+        # futures of the door manager's I/O layer, the locale and doors ones are set once the auth token is known
+        self._offline_values = door_manager.spawn(door_manager.run_blocking(
+            self.offline_auth.get, door_manager.phone_number)) if self.offline_auth else door_manager.resolved({})
+        self._user_locale = None
+        self._doors = None
+        self._auth_token = door_manager.spawn(self._get_auth_token())
+
+    async def _get_auth_token(self) -> typing.Optional[str]:
+        door_manager = self.door_manager
+        if await door_manager.use_session_bootstrap():
+            session = await door_manager.bootstrap_session()
+            if session is not None:
+                auth_token, user_locale, doors = session
+                if auth_token is not None:
+                    door_manager.backend_auth_token = auth_token
+                    self._user_locale, self._doors = door_manager.resolved(user_locale), door_manager.resolved(doors)
+                return auth_token
+
+        auth_token = await door_manager.get_auth_token()
+        if auth_token is not None:
+            door_manager.backend_auth_token = auth_token
+            self._user_locale = door_manager.spawn(door_manager.get_user_locale())
+            self._doors = door_manager.spawn(door_manager.get_doors())
+        return auth_token
+
+    async def _result(self, lookup: str, get_future: typing.Callable[[], typing.Any]):
+        door_manager = self.door_manager
+        offline_values = await door_manager.wait_for_result(self._offline_values)
+        if lookup in offline_values:
+            error = 'the auth token came from the offline auth store'
+            try:
+                if get_future() is not None:
+                    return await door_manager.wait_for_result(get_future(), self.offline_auth.deadline)
+            except TimeoutError:
+                error = f'no answer within {self.offline_auth.deadline}s'
+            except ValueError as exc:
+                if not door_manager.is_backend_outage(exc):
+                    raise
+                error = repr(exc)
+            await door_manager.verbose('Using the offline %s of %r - %s' % (lookup, door_manager.phone_number, error))
+            self.offline_lookups.append(lookup)
+            return offline_values[lookup]
+
+        if get_future() is None and await door_manager.wait_for_result(self._auth_token) is None:
+            # the auth token came from the offline auth store, but the backend no longer knows the phone number
+            raise ValueError(f"Phone number {door_manager.phone_number!r} is no longer known to the backend")
+        return await door_manager.wait_for_result(get_future())
+
+    async def auth_token(self) -> typing.Optional[str]:
+        """
+        :raises ValueError: on any exception
+        """
+        return await self._result('auth_token', lambda: self._auth_token)
+
+    async def user_locale(self) -> str:
+        """
+        Must only be called once ``auth_token()`` returned a token.
+
+        :raises ValueError: on any exception
+        """
+        return await self._result('locale', lambda: self._user_locale)
+
+    async def doors(self):
+        """
+        Must only be called once ``auth_token()`` returned a token.
+
+        :raises ValueError: on any exception
+        """
+        return await self._result('doors', lambda: self._doors)
+
+
+class AbstractDoorManager(abc.ABC):
+    """
+    The call flow shared by all the door managers - the AGI commands and the backend requests of a call, written as
+    coroutines on top of a few I/O primitives (``send_line``, ``send_request``, ``spawn``, ...) implemented by:
 
-class AbstractDoorManager(AGI, abc.ABC):
+    - ``BlockingDoorManager`` - pyst2's AGI and threads, for the AGI script and the threaded FastAGI server. Nothing
+      in it suspends, so the coroutines run to the end in the call's thread (see ``run_sync``).
+    - ``door_ivr_async.AsyncDoorManager`` - asyncio streams, aiohttp and tasks, for the asyncio FastAGI server.
+    """
+    handler_name: str
 
-    def __init__(self, config_filename: str, phone_number: typing.Optional[str] = None):
-        super().__init__()
+    def __init__(self, config: configparser.ConfigParser, phone_number: typing.Optional[str] = None):
+        self.timings = CallTimings(self.handler_name)
 
-        self.config = configparser.ConfigParser()
-        self.config.read(config_filename)
+        self.config = config
         self.auth_backend_api_url = self.config['backend']['auth_api_url']
         self.door_backend_api_url = self.config['backend']['door_api_url']
         self.backend_access_secret = self.config['backend']['access_secret']
         self.asterisk_fallback_extension_var = self.config['asterisk']['fallback_extension_var']
         self.asterisk_fallback_extension = self.config['asterisk']['fallback_extension']
         self.backend_auth_token = None
+        # time.monotonic() after which this call sends no more backend requests - a deadline rather than a sum of
+        # the request durations, so concurrent requests don't use up the budget twice
+        self.backend_deadline = time.monotonic() + self.config.getfloat('timeouts', 'call_budget', fallback=20)
 
         self.phone_number = phone_number or self.env['agi_callerid']
 
-        self.sounds_path = Path.cwd().joinpath('initlab-telephony-assets', 'files')
+        self.sounds_path = get_sounds_path()
         # default locale for unknown or unauthorized calls
         self.user_locale = 'bg'
         self.pin = ''
 
-    def get_auth_token(self) -> typing.Optional[str]:
+    @property
+    @abc.abstractmethod
+    def backend_errors(self) -> typing.Tuple[typing.Type[Exception], ...]:
+        """
+        The exception types of failed backend requests - see ``send_request``.
+        """
+
+    @property
+    @abc.abstractmethod
+    def backend_outage_errors(self) -> typing.Tuple[typing.Type[Exception], ...]:
+        """
+        The ``backend_errors`` raised when the backend can't be reached or doesn't answer in time.
+        """
+
+    @abc.abstractmethod
+    async def send_line(self, line: str):
+        """
+        Send an AGI command to Asterisk.
+        """
+
+    @abc.abstractmethod
+    async def read_line(self) -> str:
+        """
+        :return: the next line from Asterisk, stripped
+        :raises AGIHangup: if Asterisk closed the connection
+        """
+
+    @abc.abstractmethod
+    async def send_request(self, method: str, url: str, timeout: typing.Tuple[float, float],
+                           data: typing.Optional[dict] = None,
+                           headers: typing.Optional[typing.Dict[str, str]] = None) -> typing.Tuple[int, bytes]:
+        """
+        Send an HTTP request with an optional form-encoded body and read the whole response.
+
+        :param timeout: ``(connect, read)`` timeouts in seconds
+        :return: the status code and the body
+        :raises backend_errors: on any network or protocol error
+        """
+
+    @abc.abstractmethod
+    async def run_blocking(self, function: typing.Callable, *args):
+        """
+        Call ``function(*args)``, which blocks on the file system or a database, without holding up other calls.
+        """
+
+    @abc.abstractmethod
+    def spawn(self, coroutine: typing.Coroutine, urgent: bool = False):
+        """
+        Run a coroutine in the background.
+
+        :param urgent: start it right away, without waiting for a free worker
+        :return: a future of its result - see ``wait_for_result`` and ``wait_first``
+        """
+
+    @abc.abstractmethod
+    def resolved(self, value):
+        """
+        :return: a future which already has the result ``value``
+        """
+
+    @abc.abstractmethod
+    async def wait_for_result(self, future, timeout: typing.Optional[float] = None):
+        """
+        Return the result of a future, waiting up to ``timeout`` seconds (None - no limit) for it.
+
+        :raises TimeoutError: if the future is not done by then - it is not cancelled
+        """
+
+    @abc.abstractmethod
+    async def wait_first(self, futures: typing.Iterable, timeout: typing.Optional[float]) -> set:
+        """
+        Wait up to ``timeout`` seconds (None - no limit) for any of ``futures`` to be done.
+
+        :return: the futures which are done, empty on a timeout
+        """
+
+    @abc.abstractmethod
+    def detach(self, future):
+        """
+        Let a future nobody waits for anymore run to the end without reporting its exception.
+        """
+
+    @abc.abstractmethod
+    async def sleep(self, seconds: float):
+        pass
+
+    @abc.abstractmethod
+    async def run_concurrently(self, coroutines: typing.List[typing.Coroutine], limit: int) -> list:
+        """
+        Run the coroutines, up to ``limit`` of them at a time.
+
+        :return: the result or the exception of every coroutine, in order
+        """
+
+    async def call_cache(self, method: typing.Callable, *args):
+        """
+        Call a method of a process-wide cache, through ``run_blocking`` if the cache's store blocks - see
+        ``SQLiteCacheStore``.
+        """
+        if method.__self__.store.blocking:
+            return await self.run_blocking(method, *args)
+        return method(*args)
+
+    @staticmethod
+    def _quote(string) -> str:
+        return '"%s"' % string
+
+    @staticmethod
+    def _process_digit_list(digits) -> str:
+        if isinstance(digits, list):
+            digits = ''.join(map(str, digits))
+        return AbstractDoorManager._quote(digits)
+
+    @staticmethod
+    def _result_to_char(res: str) -> str:
+        if res == '0':
+            return ''
+        try:
+            return chr(int(res))
+        except ValueError:
+            raise AGIError('Unable to convert result to char: %s' % res)
+
+    async def execute(self, command: str, *args) -> typing.Dict[str, typing.Tuple[str, str]]:
+        with self.timings.time('agi_' + command.strip().lower().replace(' ', '_')):
+            await self.send_line(('%s %s' % (command.strip(), ' '.join(map(str, args)))).strip())
+            return await self.get_result()
+
+    async def get_result(self) -> typing.Dict[str, typing.Tuple[str, str]]:
+        """
+        pyst2's ``get_result``, parsing empty values (see ``AGI_RESULT_KV_RE``) and skipping the ``HANGUP`` line
+        Asterisk sends to FastAGI scripts when the channel hangs up.
+        """
+        line = await self.read_line()
+        if line == 'HANGUP':
+            line = await self.read_line()
+        code, response = 0, ''
+        match = re_code.search(line)
+        if match:
+            code, response = match.groups()
+            code = int(code or 0)
+
+        if code == 200:
+            result = {'result': ('', '')}
+            for key, value, data in AGI_RESULT_KV_RE.findall(response):
+                result[key] = (value, data)
+
+                # If user hangs up... we get 'hangup' in the data
+                if data == 'hangup':
+                    raise AGIResultHangup("User hungup during execution")
+
+                if key == 'result' and value == '-1':
+                    raise AGIAppError("Error executing application, or hangup")
+            return result
+        elif code == 510:
+            raise AGIInvalidCommand(response)
+        elif code == 520:
+            usage = [line]
+            line = await self.read_line()
+            while line[:3] != '520':
+                usage.append(line)
+                line = await self.read_line()
+            usage.append(line)
+            raise AGIUsageError('%s\n' % '\n'.join(usage))
+        else:
+            raise AGIUnknownError(code, 'Unhandled code or undefined response')
+
+    async def answer(self):
+        await self.execute('ANSWER')
+
+    async def hangup(self):
+        await self.execute('HANGUP')
+
+    async def verbose(self, message, level=1):
+        await self.execute('VERBOSE', self._quote(message), level)
+
+    async def stream_file(self, filename, escape_digits: typing.Union[str, typing.List[int]] = '',
+                          sample_offset=0) -> str:
+        response = await self.execute('STREAM FILE', filename, self._process_digit_list(escape_digits), sample_offset)
+        return self._result_to_char(response['result'][0])
+
+    async def say_digits(self, digits, escape_digits: typing.Union[str, typing.List[int]] = '') -> str:
+        response = await self.execute('SAY DIGITS', self._process_digit_list(digits),
+                                      self._process_digit_list(escape_digits))
+        return self._result_to_char(response['result'][0])
+
+    async def wait_for_digit(self, timeout) -> str:
+        return self._result_to_char((await self.execute('WAIT FOR DIGIT', timeout))['result'][0])
+
+    async def read_digits(self, timeout: int) -> typing.Tuple[str, bool]:
+        """
+        Collect digits up to ``#`` (or ``MAX_INPUT_DIGITS``) with a single GET DATA without a prompt,
+        instead of a WAIT FOR DIGIT per digit.
+
+        :param timeout: milliseconds to wait for each digit
+        :return: the digits without the ``#`` and whether waiting for a digit timed out
+        """
+        digits, data = (await self.execute('GET DATA', '""', timeout, MAX_INPUT_DIGITS))['result']
+        return digits, data == 'timeout'
+
+    async def get_variable(self, name) -> str:
+        try:
+            result = await self.execute('GET VARIABLE', self._quote(name))
+        except AGIResultHangup:
+            result = {'result': ('1', 'hangup')}
+        return result['result'][1]
+
+    async def set_extension(self, extension):
+        await self.execute('SET EXTENSION', extension)
+
+    async def set_priority(self, priority):
+        await self.execute('set priority', priority)
+
+    async def handle_and_record_phone_call(self):
+        """
+        Handle the call and export the timings of its stages - see ``CallTimings.export``.
+        """
+        try:
+            with self.timings.time('call'):
+                await self.handle_phone_call()
+        finally:
+            self.timings.export(self.config)
+
+    async def backend_request(self, method: str, backend: str, endpoint: str, url: str,
+                              data: typing.Optional[dict] = None,
+                              headers: typing.Optional[typing.Dict[str, str]] = None,
+                              ok_statuses: typing.Collection[int] = ()) -> typing.Tuple[int, typing.Any]:
+        """
+        Send a request to the ``auth`` or ``door`` backend through its circuit breaker, with the ``endpoint``'s
+        timeout from the ``[timeouts]`` section capped by the time left until the call's ``backend_deadline``.
+
+        A 401 forgets the caller's auth token before it is raised - see ``forget_auth_token``.
+
+        :param ok_statuses: error statuses to return instead of raising them, e.g. 404 for unknown phone numbers
+        :return: the status code and the decoded JSON body (None for empty bodies and error statuses)
+        :raises backend_errors: on any exception, including an open circuit breaker and error statuses
+                                (``BackendHTTPError``)
+        """
+        timeout = get_backend_timeout(self.config, endpoint, self.backend_deadline - time.monotonic())
+
+        circuit_breaker = get_circuit_breaker(self.config, backend)
+        circuit_breaker.before_request()
+        try:
+            status, content = await self.send_request(method, url, timeout, data=data, headers=headers)
+        except self.backend_errors:
+            circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            circuit_breaker.record_abandoned()
+            raise
+
+        if status >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+
+        if status >= 400:
+            if status in ok_statuses:
+                return status, None
+            if status == 401:
+                await self.forget_auth_token()
+            kind = 'Client' if status < 500 else 'Server'
+            raise BackendHTTPError(f"{status} {kind} Error for url: {url}", status)
+        try:
+            return status, json.loads(content) if content else None
+        except ValueError as exc:
+            raise BackendRequestError(exc) from exc
+
+    def is_backend_outage(self, exc: Exception) -> bool:
+        """
+        Whether a backend request (or a lookup which wrapped its error in a ``ValueError``) failed because the
+        backend is down or slow - an open circuit breaker, a connection error, a timeout or a 5xx status - and not
+        because the backend answered it, e.g. rejected the auth token with a 401 or 403.
+        """
+        if isinstance(exc, ValueError) and exc.__cause__ is not None:
+            exc = exc.__cause__
+        if isinstance(exc, BackendHTTPError):
+            return exc.status is None or exc.status >= 500
+        return isinstance(exc, self.backend_outage_errors)
+
+    def authorization(self) -> typing.Dict[str, str]:
+        return {'Authorization': f"Bearer {self.backend_auth_token}"}
+
+    async def forget_auth_token(self):
+        """
+        Forget the cached auth token of the caller, everything cached for it and the caller's offline auth state -
+        the backend rejected the token.
+        """
+        await self.call_cache(auth_token_cache.delete, self.phone_number)
+        await self.call_cache(doors_cache.delete, self.backend_auth_token)
+        await self.call_cache(user_locale_cache.delete, self.backend_auth_token)
+        await self.update_offline_auth(OfflineAuthStore.delete)
+
+    @timed_stage('get_auth_token')
+    async def get_auth_token(self) -> typing.Optional[str]:
         """
         Return an OAuth token representing the user with the phone in question
         or return None if the user is not found.
 
+        Tokens are cached until shortly before their ``expires_at`` and unknown numbers
+        are cached for ``[cache] unknown_number_ttl`` seconds.
+
         :raises ValueError: on any exception
         """
+        cached_token = await self.call_cache(auth_token_cache.get, self.phone_number, _MISSING)
+        if cached_token is not _MISSING:
+            return cached_token
+
         try:
-            response = requests.post(f"{self.auth_backend_api_url}/phone_access/phone_number_token",
-                                     data={
-                                         'secret': self.backend_access_secret,
-                                         'phone_number': self.phone_number,
-                                     })
-            if response.status_code == 404:
+            status, body = await self.backend_request('POST', 'auth', 'phone_number_token',
+                                                      f"{self.auth_backend_api_url}/phone_access/phone_number_token",
+                                                      data={
+                                                          'secret': self.backend_access_secret,
+                                                          'phone_number': self.phone_number,
+                                                      },
+                                                      ok_statuses=(404,))
+            if status == 404:
+                await self.call_cache(auth_token_cache.set, self.phone_number, None,
+                                      self.config.getfloat('cache', 'unknown_number_ttl', fallback=60))
+                await self.update_offline_auth(OfflineAuthStore.delete)
                 return None
-            response.raise_for_status()
-            return response.json()['auth_token']['token']
-        except (requests.exceptions.RequestException, KeyError) as exc:
+            auth_token = body['auth_token']
+            token = auth_token['token']
+        except (*self.backend_errors, KeyError, TypeError) as exc:
             raise ValueError(exc) from exc
 
-    def is_correct_pin(self) -> bool:
+        auth_token_ttl = get_auth_token_ttl(self.config, auth_token)
+        await self.call_cache(auth_token_cache.set, self.phone_number, token, auth_token_ttl)
+        await self.update_offline_auth(OfflineAuthStore.set_auth_token, token, auth_token_ttl)
+        return token
+
+    async def use_session_bootstrap(self) -> bool:
+        """
+        Whether to look up the auth token, locale and doors with a single ``bootstrap_session()`` request - if
+        ``[backend] session_bootstrap`` is enabled, the backend has the endpoint and the auth token is not cached
+        (then the other lookups are usually cached too).
+        """
+        return (self.config.getboolean('backend', 'session_bootstrap', fallback=False)
+                and not await self.call_cache(session_bootstrap_missing.get, self.auth_backend_api_url)
+                and await self.call_cache(auth_token_cache.get, self.phone_number, _MISSING) is _MISSING)
+
+    @timed_stage('bootstrap_session')
+    async def bootstrap_session(self) -> typing.Optional[typing.Tuple[typing.Optional[str], typing.Optional[str],
+                                                                      typing.Optional[list]]]:
+        """
+        Return the auth token, the locale and the doors of the user with the phone in question from a single
+        request, instead of phone_number_token followed by current_user and doors. Fills the same caches.
+
+        :return: ``(auth token, locale, doors)``, ``(None, None, None)`` if the user is not found or None if the
+                 backend has no session_bootstrap endpoint (404) - then it is not asked again for
+                 ``[cache] session_bootstrap_missing_ttl`` seconds
+        :raises ValueError: on any exception
+        """
+        try:
+            status, session = await self.backend_request('POST', 'auth', 'session_bootstrap',
+                                                         f"{self.auth_backend_api_url}/phone_access/session_bootstrap",
+                                                         data={
+                                                             'secret': self.backend_access_secret,
+                                                             'phone_number': self.phone_number,
+                                                         },
+                                                         ok_statuses=(404,))
+            if status == 404:
+                await self.call_cache(session_bootstrap_missing.set, self.auth_backend_api_url, True,
+                                      self.config.getfloat('cache', 'session_bootstrap_missing_ttl', fallback=3600))
+                return None
+            auth_token = session['auth_token']
+            if auth_token is None:
+                await self.call_cache(auth_token_cache.set, self.phone_number, None,
+                                      self.config.getfloat('cache', 'unknown_number_ttl', fallback=60))
+                await self.update_offline_auth(OfflineAuthStore.delete)
+                return None, None, None
+            token = auth_token['token']
+            user_locale = session['user']['locale']
+            doors = session['doors']
+        except (*self.backend_errors, KeyError, TypeError) as exc:
+            raise ValueError(exc) from exc
+
+        auth_token_ttl = get_auth_token_ttl(self.config, auth_token)
+        await self.call_cache(auth_token_cache.set, self.phone_number, token, auth_token_ttl)
+        await self.call_cache(user_locale_cache.set, token, user_locale,
+                              self.config.getfloat('cache', 'user_locale_ttl', fallback=3600))
+        await self.call_cache(doors_cache.set, token, doors)
+        await self.update_offline_auth(OfflineAuthStore.set_auth_token, token, auth_token_ttl)
+        await self.update_offline_auth(OfflineAuthStore.set, 'locale', user_locale)
+        await self.update_offline_auth(OfflineAuthStore.set, 'doors', doors)
+        return token, user_locale, doors
+
+    async def update_offline_auth(self, update: typing.Callable[..., None], *args):
+        """
+        Call ``update(offline_auth_store, phone_number, *args)`` if there is an offline auth store.
+        Failing to update it only affects later calls, so it is not an error of this call.
+        """
+        offline_auth = get_offline_auth_store(self.config)
+        if offline_auth is None:
+            return
+        try:
+            await self.run_blocking(update, offline_auth, self.phone_number, *args)
+        except OSError as exc:
+            sys.stderr.write('Updating the offline auth store failed - %r\n' % exc)
+
+    @timed_stage('is_correct_pin')
+    async def is_correct_pin(self) -> bool:
+        """
+        Verify the pin with the backend or, if the backend is down (see ``is_backend_outage``) or misses the
+        deadline, with the offline auth store.
+
+        :raises ValueError: if the backend rejected the request, e.g. the auth token was revoked
+        """
+        offline_auth = get_offline_auth_store(self.config)
         try:
-            response = requests.post(f"{self.auth_backend_api_url}/phone_access/verify_pin",
-                                     data={'pin': self.pin},
-                                     headers={'Authorization': f"Bearer {self.backend_auth_token}"})
-            response.raise_for_status()
-            return response.json()['pin'] == 'valid'
-        except (requests.exceptions.RequestException, KeyError) as exc:
-            self.verbose('Error verifying pin - %r' % exc)
+            if offline_auth is None:
+                return await self.verify_pin(self.pin)
+            # an answer after the deadline still updates the offline auth store
+            return await self.wait_for_result(self.spawn(self.verify_pin(self.pin)), offline_auth.deadline)
+        except TimeoutError:
+            await self.verbose('Error verifying pin - no answer within %ss' % offline_auth.deadline)
+        except ValueError as exc:
+            await self.verbose('Error verifying pin - %r' % exc)
+            if not self.is_backend_outage(exc):
+                raise
+        if offline_auth is None:
             return False
+        await self.verbose('Verifying the pin of %r with the offline auth store' % self.phone_number)
+        return await self.run_blocking(offline_auth.check_pin, self.phone_number, self.pin)
+
+    async def verify_pin(self, pin: str) -> bool:
+        """
+        Ask the backend if ``pin`` is correct and remember the answer in the offline auth store, if there is one.
 
-    def get_user_locale(self) -> str:
+        :raises ValueError: on any exception
+        """
         try:
-            response = requests.get(f"{self.auth_backend_api_url}/current_user", headers={
-                'Authorization': f"Bearer {self.backend_auth_token}"
-            })
-            response.raise_for_status()
-            return response.json()['locale']
-        except (requests.exceptions.RequestException, KeyError) as exc:
+            _, body = await self.backend_request('POST', 'auth', 'verify_pin',
+                                                 f"{self.auth_backend_api_url}/phone_access/verify_pin",
+                                                 data={'pin': pin}, headers=self.authorization())
+            valid = body['pin'] == 'valid'
+        except (*self.backend_errors, KeyError, TypeError) as exc:
             raise ValueError(exc) from exc
 
-    def get_doors(self):
+        if get_offline_auth_store(self.config) is not None:
+            # hashing the pin is slow on purpose - done after answering
+            self.spawn(self.update_offline_auth(OfflineAuthStore.set_pin, pin if valid else None))
+        return valid
+
+    @timed_stage('get_user_locale')
+    async def get_user_locale(self) -> str:
+        """
+        Return the locale of the user, cached per auth token for ``[cache] user_locale_ttl`` seconds.
+
+        :raises ValueError: on any exception
+        """
+        user_locale = await self.call_cache(user_locale_cache.get, self.backend_auth_token)
+        if user_locale is None:
+            user_locale = await self.fetch_user_locale()
+            await self.call_cache(user_locale_cache.set, self.backend_auth_token, user_locale,
+                                  self.config.getfloat('cache', 'user_locale_ttl', fallback=3600))
+        return user_locale
+
+    async def fetch_user_locale(self) -> str:
         try:
-            response = requests.get(f"{self.door_backend_api_url}/doors", headers={
-                'Authorization': f"Bearer {self.backend_auth_token}"
-            })
-            response.raise_for_status()
-            return response.json()
-        except (requests.exceptions.RequestException, KeyError) as exc:
+            _, body = await self.backend_request('GET', 'auth', 'current_user',
+                                                 f"{self.auth_backend_api_url}/current_user",
+                                                 headers=self.authorization())
+            locale = body['locale']
+        except (*self.backend_errors, KeyError, TypeError) as exc:
             raise ValueError(exc) from exc
 
-    def perform_door_action(self, door_id, action):
-        response = requests.post(f"{self.door_backend_api_url}/doors/{door_id}/{action}",
-                                 headers={'Authorization': f"Bearer {self.backend_auth_token}"})
-        response.raise_for_status()
+        await self.update_offline_auth(OfflineAuthStore.set, 'locale', locale)
+        return locale
+
+    @timed_stage('get_doors')
+    async def get_doors(self):
+        """
+        Return the doors of the user, cached per auth token - see ``StaleWhileRevalidateCache``. Stale doors are
+        refreshed in the background.
+
+        :raises ValueError: on any exception
+        """
+        found, doors, refresh = await self.call_cache(
+            doors_cache.lookup, self.backend_auth_token,
+            self.config.getfloat('cache', 'doors_ttl', fallback=60),
+            self.config.getfloat('cache', 'doors_max_stale', fallback=3600),
+        )
+        if refresh:
+            self.spawn(self._refresh_doors(self.backend_auth_token))
+        if found:
+            return doors
+
+        doors = await self.fetch_doors()
+        await self.call_cache(doors_cache.set, self.backend_auth_token, doors)
+        return doors
+
+    async def _refresh_doors(self, auth_token: str):
+        try:
+            doors = await self.fetch_doors()
+        except Exception:
+            doors_cache.end_refresh(auth_token, failed=True)
+        else:
+            await self.call_cache(doors_cache.set, auth_token, doors)
+            doors_cache.end_refresh(auth_token)
+
+    async def fetch_doors(self):
+        try:
+            _, doors = await self.backend_request('GET', 'door', 'doors', f"{self.door_backend_api_url}/doors",
+                                                  headers=self.authorization())
+        except self.backend_errors as exc:
+            raise ValueError(exc) from exc
+
+        await self.update_offline_auth(OfflineAuthStore.set, 'doors', doors)
+        return doors
+
+    @timed_stage('perform_door_action')
+    async def perform_door_action(self, door_id, action):
+        """
+        Send a door action to portier with an ``Idempotency-Key``, so it acts once on all of these attempts: a hedged
+        duplicate of an attempt slower than usual and retries of failed attempts after a jittered backoff, while the
+        call's backend time budget lasts (see ``DoorActionPolicy``). The winning attempt is recorded as the
+        ``door_action_first``, ``door_action_hedge`` or ``door_action_retry`` stage.
+
+        :raises backend_errors: if the last attempt failed or portier rejected the action
+        """
+        import uuid
+
+        policy = get_door_action_policy(self.config)
+        url = f"{self.door_backend_api_url}/doors/{door_id}/{action}"
+        headers = {**self.authorization(), 'Idempotency-Key': uuid.uuid4().hex}
+
+        error = None
+        for retry in range(policy.retries + 1):
+            if retry:
+                backoff = policy.backoff(retry)
+                if time.monotonic() + backoff >= self.backend_deadline:
+                    break
+                await self.sleep(backoff)
+            attempts = {
+                self.spawn(self.door_action_attempt(policy, url, headers), urgent=True): 'retry' if retry else 'first',
+            }
+            hedge_delay = policy.hedge_delay()
+            try:
+                while attempts:
+                    done = await self.wait_first(attempts, hedge_delay)
+                    if not done:  # the attempt is slow - the first answer of the two wins
+                        attempts[self.spawn(self.door_action_attempt(policy, url, headers), urgent=True)] = 'hedge'
+                        hedge_delay = None
+                        continue
+                    for future in done:
+                        attempt = attempts.pop(future)
+                        try:
+                            seconds = future.result()
+                        except BackendUnavailableError:
+                            raise  # the circuit breaker is open or the budget is used up
+                        except BackendHTTPError as exc:
+                            if exc.status not in DOOR_ACTION_RETRY_STATUS_CODES:
+                                raise
+                            error = exc
+                            continue
+                        except self.backend_errors as exc:
+                            error = exc
+                            continue
+                        self.timings.record('door_action_' + attempt, seconds)
+                        return
+            finally:
+                # a losing attempt is not cancelled, so it still counts for the circuit breaker and the latencies
+                for future in attempts:
+                    self.detach(future)
+        raise error
 
-    def check_assets_installed(self) -> bool:
-        if not Path.is_dir(self.sounds_path):
-            self.verbose('Assets not found at %s. Please install them first' % self.sounds_path)
-            self.hangup()
+    async def door_action_attempt(self, policy: DoorActionPolicy, url: str, headers: typing.Dict[str, str]) -> float:
+        """
+        :return: the duration of a single successful door action request
+        """
+        started_at = time.monotonic()
+        await self.backend_request('POST', 'door', 'door_action', url, headers=headers)
+        seconds = time.monotonic() - started_at
+        policy.record_latency(seconds)
+        return seconds
+
+    @timed_stage('check_assets')
+    async def check_assets_installed(self) -> bool:
+        if get_asset_manifest(self.config) is None and not Path.is_dir(self.sounds_path):
+            await self.verbose('Assets not found at %s. Please install them first' % self.sounds_path)
+            await self.hangup()
             return False
         return True
 
-    def stream_file_asset(self, filename, escape_digits: typing.Union[str, typing.List[int]] = '', sample_offset=0):
-        return self.stream_file(str(self.sounds_path.joinpath(filename)), escape_digits, sample_offset)
+    async def stream_file_asset(self, filename, escape_digits: typing.Union[str, typing.List[int]] = '',
+                                sample_offset=0):
+        return await self.stream_file(str(self.sounds_path.joinpath(filename)), escape_digits, sample_offset)
 
-    def stream_file_i18n(self, filename, escape_digits: typing.Union[str, typing.List[int]] = '', sample_offset=0):
-        return self.stream_file_asset(Path(self.user_locale).joinpath(filename), escape_digits, sample_offset)
+    async def stream_file_i18n(self, filename, escape_digits: typing.Union[str, typing.List[int]] = '',
+                               sample_offset=0):
+        return await self.stream_file_asset(
+            localize_prompt(get_asset_manifest(self.config), self.user_locale, filename), escape_digits, sample_offset)
 
-    def stream_and_capture_digit(self, filename):
-        return self.stream_file_i18n(filename, escape_digits=DIGITS)  # '' on no input
+    async def has_prompt_i18n(self, filename) -> bool:
+        """
+        Return whether the prompt ``filename`` exists in the caller's locale (or the fallback locale) - according to
+        the asset manifest or, without one, the files in the sounds path. STREAM FILE of a missing prompt fails and
+        ends the call, so the prompts the assets don't have yet are skipped.
+        """
+        manifest = get_asset_manifest(self.config)
+        prompt = self.sounds_path.joinpath(localize_prompt(manifest, self.user_locale, filename))
+        if manifest is not None:
+            return bool(manifest.get_formats(prompt))
+        return bool(await self.run_blocking(PromptCompositor.get_formats, prompt))
 
-    def answer_and_wait(self):
-        self.answer()
-        time.sleep(1)  # if we don't sleep the first part of the next audio file is skipped
+    async def stream_and_capture_digit(self, filename):
+        return await self.stream_file_i18n(filename, escape_digits=DIGITS)  # '' on no input
 
-    def end_call(self):
-        self.stream_file_i18n('goodbye')
-        self.hangup()
+    async def answer_and_wait(self):
+        await self.answer()
+        await self.sleep(1)  # if we don't sleep the first part of the next audio file is skipped
 
-    def answer_wait_greet_stream_and_end_call(self, filename):
-        self.answer_and_wait()
-        self.stream_file_i18n('welcome')
-        self.stream_file_i18n(filename)
-        self.end_call()
+    async def end_call(self):
+        await self.stream_file_i18n('goodbye')
+        await self.hangup()
 
-    def prompt_for_pin(self):
-        next_digit = self.stream_and_capture_digit('enter_pin')
+    async def greet_stream_and_end_call(self, filename):
+        await self.stream_file_i18n('welcome')
+        await self.stream_file_i18n(filename)
+        await self.end_call()
+
+    async def answer_wait_greet_stream_and_end_call(self, filename):
+        await self.answer_and_wait()
+        await self.greet_stream_and_end_call(filename)
+
+    def start_backend_lookups(self) -> BackendLookups:
+        return BackendLookups(self)
+
+    async def prompt_for_pin(self):
+        next_digit = await self.stream_and_capture_digit('enter_pin')
         self.pin += next_digit
-        while next_digit != '#':
+        if not self.pin:
             # we give a bit more time for the first digit
-            next_digit = self.wait_for_digit(4000 if len(self.pin) else 12000)
+            next_digit = await self.wait_for_digit(12000)
             if not next_digit:
                 raise ValueError("Failed to enter pin within the timeout")
             self.pin += next_digit
+        if next_digit != '#':
+            digits, timed_out = await self.read_digits(4000)
+            if timed_out:
+                raise ValueError("Failed to enter pin within the timeout")
+            self.pin += digits
 
         self.pin = self.pin.rstrip('#')
 
-    def user_knows_the_pin(self) -> bool:
+    async def user_knows_the_pin(self) -> bool:
         for attempt_number in range(ALLOWED_CODE_ENTERING_ATTEMPTS_COUNT):
             try:
-                self.prompt_for_pin()
+                await self.prompt_for_pin()
             except ValueError:
                 # pin entry timed out, enter_pin message will be played again
                 self.pin = ''
             else:
-                if self.is_correct_pin():
+                if await self.is_correct_pin():
                     return True
                 else:
-                    self.pin = self.stream_and_capture_digit('wrong_pin')
+                    self.pin = await self.stream_and_capture_digit('wrong_pin')
 
-    def handle_choices_menu(self, doors):
-        # backwards compatible if not all doors have numbers 1-8
-        available_numbers = set(range(1, 9))
-        free_numbers = iter(sorted(available_numbers - set(door.get('number', -1) for door in doors)))
-
-        doors_map = {
-            door.get('number') if door.get('number') in available_numbers else next(free_numbers): door
-            for door in doors
-        }
-
-        assert len(doors) == len(doors_map), 'There are door number duplicates!'
+    async def pin_checked(self) -> bool:
+        """
+        Ask for the pin until the user enters the correct one, ending the call if they don't or the backend
+        rejected checking it.
 
-        door_action_choices = [
-            str(door_number) for door_number, door in doors_map.items()
-            if {DOOR_UNLOCK, DOOR_OPEN}.intersection(set(door['supported_actions']))
-        ] + ['9']
+        :return: whether the user knows the pin
+        """
+        try:
+            if await self.user_knows_the_pin():
+                return True
+        except ValueError as exc:
+            await self.verbose('Verifying the pin of %r was rejected - %r' % (self.phone_number, exc))
+            await self.stream_file_i18n('insufficient_permissions')
+        await self.end_call()
+        return False
+
+    async def handle_choices_menu(self, doors):
+        doors_map = build_doors_map(doors)
+        door_action_choices = get_door_action_choices(doors_map)
 
         selection = ''
 
         while True:  # timeout handled inside
-            # TODO: consider getting the door statuses when there is an API for this
-            for door_number in door_action_choices:
-                if not selection:
-                    selection = self.stream_file_i18n('door_prompt_' + door_number, escape_digits=DIGITS)
-
             if not selection:
-                selection = self.stream_file_asset('waiting_on_input', escape_digits=DIGITS)
-                # for some reason wait_for_digit didn't work for 5 min...
+                selection = await self.announce_door_statuses(doors_map)
             if not selection:
-                self.end_call()
+                selection = await self.stream_door_menu(door_action_choices)
+            if not selection:
+                await self.end_call()
                 return
 
             if selection not in door_action_choices:
                 # wrong selection
-                selection = self.stream_file_i18n('wrong_selection', escape_digits=DIGITS)
+                selection = await self.stream_file_i18n('wrong_selection', escape_digits=DIGITS)
             elif selection == '9':
-                lockable_door_ids = [door['id'] for door in doors if DOOR_LOCK in door['supported_actions']]
-                if not lockable_door_ids:
-                    selection = self.stream_file_i18n('lock_failed', escape_digits=DIGITS)
+                lockable_doors_map = {
+                    door_number: door for door_number, door in doors_map.items()
+                    if DOOR_LOCK in door['supported_actions']
+                }
+                if not lockable_doors_map:
+                    selection = await self.stream_file_i18n('lock_failed', escape_digits=DIGITS)
                 else:
-                    try:
-                        for door_id in lockable_door_ids:
-                            self.perform_door_action(door_id, 'lock')
-                        # Ideally we would wait until the door is confirmed to be locked,
-                        # however, there is no such API at the moment.
-                        self.stream_file_i18n('door_locked')
-                        self.end_call()  # nothing more to do - let's save some actions for the user
+                    lock_errors = await self.lock_doors(lockable_doors_map)
+                    if not lock_errors:
+                        lock_errors = await self.confirm_doors_locked(lockable_doors_map)
+                    if not lock_errors:
+                        await self.stream_file_i18n('door_locked')
+                        await self.end_call()  # nothing more to do - let's save some actions for the user
                         return
-                    except requests.exceptions.RequestException as exc:
-                        # TODO: check that all doors are locked when there is an API
-                        self.verbose('Error locking doors - %r' % exc)
-                        selection = self.stream_file_i18n('action_unsuccessful', escape_digits=DIGITS)
-                        # we don't want to hang up - the user can retry
+                    for door_number, exc in lock_errors.items():
+                        await self.verbose('Error locking the door %r - %r' % (lockable_doors_map[door_number], exc))
+                    # tell the user which of the doors failed to lock
+                    selection = await self.stream_file_i18n('action_unsuccessful', escape_digits=DIGITS)
+                    if not selection:
+                        selection = await self.say_digits(
+                            ''.join(str(door_number) for door_number in sorted(lock_errors)), escape_digits=DIGITS)
+                    # we don't want to hang up - the user can retry
             else:
                 door = doors_map[int(selection)]
                 try:
                     for action in [DOOR_UNLOCK, DOOR_OPEN]:
                         if action in door['supported_actions']:
-                            self.perform_door_action(door['id'], action)
-                    selection = self.stream_file_i18n('door_opened_' + selection, escape_digits=DIGITS)
-                except requests.exceptions.RequestException as exc:
-                    self.verbose('Error opening the door %r - %r' % (door, exc))
-                    selection = self.stream_file_i18n('action_unsuccessful', escape_digits=DIGITS)
+                            await self.perform_door_action(door['id'], action)
+                    selection = await self.stream_file_i18n('door_opened_' + selection, escape_digits=DIGITS)
+                except self.backend_errors as exc:
+                    await self.verbose('Error opening the door %r - %r' % (door, exc))
+                    selection = await self.stream_file_i18n('action_unsuccessful', escape_digits=DIGITS)
+
+    @timed_stage('compose_door_menu')
+    async def compose_door_menu(self, door_action_choices: typing.List[str]) -> typing.Optional[Path]:
+        """
+        Return the door menu prompts joined into one file - see ``PromptCompositor``.
+        """
+        prompt_compositor = get_prompt_compositor(self.config)
+        if prompt_compositor is None:
+            return None
+        return await self.run_blocking(
+            prompt_compositor.compose,
+            f"door_menu-{self.user_locale}-{'-'.join(door_action_choices)}",
+            get_door_menu_prompts(self.sounds_path, self.user_locale, door_action_choices,
+                                  get_asset_manifest(self.config)),
+        )
+
+    async def stream_door_menu(self, door_action_choices: typing.List[str]) -> str:
+        """
+        Play the door menu, as a single file if its prompts could be joined, otherwise one prompt at a time, followed
+        by ``waiting_on_input``.
+
+        :return: the selected choice or '' on no input
+        """
+        door_menu = await self.compose_door_menu(door_action_choices)
+        if door_menu is not None:
+            selection = await self.stream_file(str(door_menu), escape_digits=DIGITS)
+        else:
+            selection = ''
+            for door_number in door_action_choices:
+                if not selection:
+                    selection = await self.stream_file_i18n('door_prompt_' + door_number, escape_digits=DIGITS)
+
+        if not selection:
+            selection = await self.stream_file_asset('waiting_on_input', escape_digits=DIGITS)
+            # for some reason wait_for_digit didn't work for 5 min...
+        return selection
+
+    async def announce_door_statuses(self, doors_map) -> str:
+        """
+        Tell the numbers of the doors which are unlocked according to the door status cache, if it runs and the assets
+        have the ``doors_unlocked`` prompt.
+
+        :return: the selected choice or '' on no input
+        """
+        door_statuses = get_door_status_cache()
+        if door_statuses is None:
+            return ''
+        unlocked_door_numbers = ''.join(
+            str(door_number) for door_number, door in sorted(doors_map.items())
+            if door_statuses.get(door['id']) == DOOR_UNLOCKED
+        )
+        if not unlocked_door_numbers or not await self.has_prompt_i18n('doors_unlocked'):
+            return ''
+        selection = await self.stream_file_i18n('doors_unlocked', escape_digits=DIGITS)
+        if not selection:
+            selection = await self.say_digits(unlocked_door_numbers, escape_digits=DIGITS)
+        return selection
+
+    @timed_stage('confirm_doors_locked')
+    async def confirm_doors_locked(self, doors_map) -> typing.Dict[int, Exception]:
+        """
+        Wait up to ``[door_status] lock_confirm_timeout`` seconds for the door status cache to report the doors in
+        ``doors_map`` locked. Without the cache (or for doors it doesn't know) the locking is not confirmed.
+
+        :return: the errors of the doors which were not confirmed to be locked by door number
+        """
+        door_statuses = get_door_status_cache()
+        if door_statuses is None:
+            return {}
+        timeout = self.config.getfloat('door_status', 'lock_confirm_timeout', fallback=5)
+        other_statuses = await self.run_blocking(
+            door_statuses.wait_for,
+            [door['id'] for door in doors_map.values() if door_statuses.get(door['id']) is not None],
+            DOOR_LOCKED, timeout)
+        return {
+            door_number: TimeoutError(f"The door is still {other_statuses[door['id']]} after {timeout}s")
+            for door_number, door in doors_map.items() if door['id'] in other_statuses
+        }
+
+    async def lock_doors(self, doors_map) -> typing.Dict[int, Exception]:
+        """
+        Lock all the doors in ``doors_map`` (door number -> door) concurrently.
+
+        :return: the errors of the doors which failed to lock by door number
+        """
+        results = await self.run_concurrently(
+            [self.perform_door_action(door['id'], DOOR_LOCK) for door in doors_map.values()],
+            self.config.getint('http', 'lock_all_workers', fallback=4),
+        )
+        return {
+            door_number: result for door_number, result in zip(doors_map, results)
+            if isinstance(result, Exception)
+        }
 
     @abc.abstractmethod
-    def handle_phone_call(self):
-        raise NotImplemented
+    async def handle_phone_call(self):
+        raise NotImplementedError
 
 
 class ExternalPhoneDoorManager(AbstractDoorManager):
+    handler_name = 'external'
 
-    def handle_phone_call(self):
-        self.verbose('External phone door IVR received a call from %r' % self.phone_number)
+    async def handle_phone_call(self):
+        await self.verbose('External phone door IVR received a call from %r' % self.phone_number)
 
-        if not self.check_assets_installed():
+        if not await self.check_assets_installed():
             return
 
+        # the backend is queried while the call is being answered
+        lookups = self.start_backend_lookups()
+        await self.answer_and_wait()
+
         try:
-            self.backend_auth_token = self.get_auth_token()
+            self.backend_auth_token = await lookups.auth_token()
         except ValueError as e:
-            self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
-            self.answer_wait_greet_stream_and_end_call('service_unavailable')
+            await self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
+            await self.greet_stream_and_end_call('service_unavailable')
             return
 
         if self.backend_auth_token is None:
             # phone number is unknown
-            fallback_extension = self.get_variable(self.asterisk_fallback_extension_var) \
+            fallback_extension = await self.get_variable(self.asterisk_fallback_extension_var) \
                                  or str(self.asterisk_fallback_extension)
-            self.answer_and_wait()
-            self.stream_file_i18n('welcome')
-            self.stream_file_i18n('redirecting_to_public_phone')
-            self.set_extension(fallback_extension)
-            self.set_priority(1)
+            await self.stream_file_i18n('welcome')
+            await self.stream_file_i18n('redirecting_to_public_phone')
+            await self.set_extension(fallback_extension)
+            await self.set_priority(1)
             return
 
-        self.user_locale = self.get_user_locale()
-
-        doors = self.get_doors()
+        try:
+            self.user_locale = await lookups.user_locale()
+            doors = await lookups.doors()
+        except ValueError as e:
+            await self.verbose('Getting the locale and doors failed for %r - %r' % (self.phone_number, e))
+            await self.greet_stream_and_end_call('service_unavailable')
+            return
 
         if not any(door['supported_actions'] for door in doors):
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            await self.greet_stream_and_end_call('insufficient_permissions')
             return
 
-        self.answer_and_wait()
-        self.pin = self.stream_and_capture_digit('welcome')  # initialize pin
+        self.pin = await self.stream_and_capture_digit('welcome')  # initialize pin
 
-        if not self.user_knows_the_pin():
-            self.end_call()
+        if not await self.pin_checked():
             return
 
-        self.handle_choices_menu(doors)
+        await self.handle_choices_menu(doors)
 
 
 class PayphoneDoorManager(AbstractDoorManager):
+    handler_name = 'payphone'
 
-    def handle_phone_call(self):
-        self.verbose("Payphone door IVR received a call")
+    async def handle_phone_call(self):
+        await self.verbose("Payphone door IVR received a call")
 
-        if not self.check_assets_installed():
+        if not await self.check_assets_installed():
             return
 
-        self.answer_and_wait()
+        await self.answer_and_wait()
 
         # get the first digit of the phone number, overwriting the value from the constructor
-        self.phone_number = self.stream_and_capture_digit('welcome')
-        digit = self.stream_and_capture_digit('enter_phone')
-        while digit != '#':
+        self.phone_number = await self.stream_and_capture_digit('welcome')
+        digit = await self.stream_and_capture_digit('enter_phone')
+        if digit != '#':
             self.phone_number += digit
-            digit = self.wait_for_digit(12000)
+            timed_out = True
+            while timed_out:  # no limit for entering the whole number, only between the digits
+                digits, timed_out = await self.read_digits(12000)
+                self.phone_number += digits
+
+        await self.verbose("Phone number %r entered on the payphone" % self.phone_number)
 
-        self.verbose("Phone number %r entered on the payphone" % self.phone_number)
+        lookups = self.start_backend_lookups()
 
         try:
-            self.backend_auth_token = self.get_auth_token()
+            self.backend_auth_token = await lookups.auth_token()
         except ValueError as e:
-            self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
-            self.stream_file_i18n('service_unavailable')
-            self.end_call()
+            await self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
+            await self.stream_file_i18n('service_unavailable')
+            await self.end_call()
             return
 
         if self.backend_auth_token is None:
             # phone number is unknown
-            fallback_extension = self.get_variable(self.asterisk_fallback_extension_var) \
+            fallback_extension = await self.get_variable(self.asterisk_fallback_extension_var) \
                                  or str(self.asterisk_fallback_extension)
-            self.stream_file_i18n('redirecting_to_public_phone')
-            self.set_extension(fallback_extension)
-            self.set_priority(1)
+            await self.stream_file_i18n('redirecting_to_public_phone')
+            await self.set_extension(fallback_extension)
+            await self.set_priority(1)
             return
 
-        self.user_locale = self.get_user_locale()
-
-        doors = self.get_doors()
+        try:
+            self.user_locale = await lookups.user_locale()
+            doors = await lookups.doors()
+        except ValueError as e:
+            await self.verbose('Getting the locale and doors failed for %r - %r' % (self.phone_number, e))
+            await self.stream_file_i18n('service_unavailable')
+            await self.end_call()
+            return
 
         if not any(door['supported_actions'] for door in doors):
-            self.stream_file_i18n('insufficient_permissions')
-            self.end_call()
+            await self.stream_file_i18n('insufficient_permissions')
+            await self.end_call()
             return
 
-        if not self.user_knows_the_pin():
-            self.end_call()
+        if not await self.pin_checked():
             return
 
-        self.handle_choices_menu(doors)
+        await self.handle_choices_menu(doors)
 
 
 class InternalPhoneDoorManager(AbstractDoorManager):
+    handler_name = 'internal'
 
-    def handle_phone_call(self):
-        self.verbose("Internal door IVR received a call from %r" % self.phone_number)
+    async def handle_phone_call(self):
+        await self.verbose("Internal door IVR received a call from %r" % self.phone_number)
 
-        if not self.check_assets_installed():
+        if not await self.check_assets_installed():
             return
 
         self.phone_number = self.config['internal_phones_mapping'].get(self.phone_number, None)
 
         if not self.phone_number:
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            await self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
             return
 
+        # the backend is queried while the call is being answered
+        lookups = self.start_backend_lookups()
+        await self.answer_and_wait()
+
         try:
-            self.backend_auth_token = self.get_auth_token()
+            self.backend_auth_token = await lookups.auth_token()
         except ValueError as e:
-            self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
-            self.answer_wait_greet_stream_and_end_call('service_unavailable')
+            await self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
+            await self.greet_stream_and_end_call('service_unavailable')
             return
 
         if self.backend_auth_token is None:
             # phone number is unknown
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            await self.greet_stream_and_end_call('insufficient_permissions')
             return
 
-        self.user_locale = self.get_user_locale()
-
-        doors = self.get_doors()
+        try:
+            self.user_locale = await lookups.user_locale()
+            doors = await lookups.doors()
+        except ValueError as e:
+            await self.verbose('Getting the locale and doors failed for %r - %r' % (self.phone_number, e))
+            await self.greet_stream_and_end_call('service_unavailable')
+            return
 
         if not any(door['supported_actions'] for door in doors):
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            await self.greet_stream_and_end_call('insufficient_permissions')
             return
 
-        self.answer_and_wait()
-        self.handle_choices_menu(doors)
+        await self.handle_choices_menu(doors)
 
 
 class InCallDoorManager(AbstractDoorManager):
+    """
+    Open a door with a feature key pressed during a call (e.g. ``#1``) - the door number comes as the phone number.
 
-    def handle_phone_call(self):
+    With the auth token, doors and locale of the internal phone cached (the servers keep them fresh, see
+    ``start_in_call_prefetch``) the door action is the only backend request. Repeated presses are debounced per
+    channel and door - see ``ChannelDebounce``.
+    """
+    handler_name = 'in-call'
+
+    async def handle_phone_call(self):
         channel = self.env['agi_channel']  # e.g., "SIP/bigroom-0000002"
         door_id = self.phone_number  # FIXME: this is a hack
-        self.verbose("In-call door IVR received a call from %r for door %s" % (channel, door_id))
+        await self.verbose("In-call door IVR received a call from %r for door %s" % (channel, door_id))
 
         match = re.fullmatch('SIP/(.+)-.+', channel)
         self.phone_number = match.group(1) if match else None
@@ -375,58 +1226,299 @@ class InCallDoorManager(AbstractDoorManager):
         self.phone_number = self.config['internal_phones_mapping'].get(self.phone_number, None)
 
         if not self.phone_number:
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            await self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
             return
 
+        debounce = self.debounce(channel, door_id)
+        try:
+            if not await self.run_blocking(debounce.claim):
+                await self.verbose('Ignoring door %s pressed again on %r' % (door_id, channel))
+                return
+            if await self.open_door(door_id):
+                await self.run_blocking(debounce.succeeded)
+        finally:
+            debounce.release()
+
+    def debounce(self, channel: str, door_id: str) -> ChannelDebounce:
+        return ChannelDebounce(
+            Path.cwd().joinpath(self.config.get('in_call', 'debounce_dir', fallback='initlab-telephony-in-call')),
+            f'{channel}-{door_id}',
+            window=self.config.getfloat('in_call', 'debounce', fallback=3),
+        )
+
+    async def open_door(self, door_id: str) -> bool:
+        """
+        :return: whether the door was opened
+        """
+        lookups = self.start_backend_lookups()
+
         try:
-            self.backend_auth_token = self.get_auth_token()
+            self.backend_auth_token = await lookups.auth_token()
         except ValueError as e:
-            self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
-            self.answer_wait_greet_stream_and_end_call('service_unavailable')
-            return
+            await self.verbose('Getting auth failed for %r - %r' % (self.phone_number, e))
+            await self.answer_wait_greet_stream_and_end_call('service_unavailable')
+            return False
 
         if self.backend_auth_token is None:
             # phone number is unknown
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
-            return
-
-        self.user_locale = self.get_user_locale()
+            await self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            return False
 
-        doors = self.get_doors()
+        try:
+            doors = await lookups.doors()
+        except ValueError as e:
+            await self.verbose('Getting the doors failed for %r - %r' % (self.phone_number, e))
+            await self.use_user_locale(lookups)
+            await self.answer_wait_greet_stream_and_end_call('service_unavailable')
+            return False
 
         if not any(door['supported_actions'] for door in doors):
-            self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
-            return
+            await self.use_user_locale(lookups)
+            await self.answer_wait_greet_stream_and_end_call('insufficient_permissions')
+            return False
 
         doors_map = {str(door.get('number')): door for door in doors}
 
+        # the locale is only needed for the prompt afterwards - the door is opened without waiting for it
         try:
-            self.perform_door_action(doors_map[door_id]['id'], DOOR_OPEN)
-        except requests.exceptions.RequestException as exc:
-            self.verbose('Error opening the door %r - %r' % (doors_map[door_id], exc))
-            self.stream_file_i18n('action_unsuccessful')
+            await self.perform_door_action(doors_map[door_id]['id'], DOOR_OPEN)
+        except self.backend_errors as exc:
+            await self.verbose('Error opening the door %r - %r' % (doors_map[door_id], exc))
+            await self.use_user_locale(lookups)
+            await self.stream_file_i18n('action_unsuccessful')
+            return False
+
+        await self.use_user_locale(lookups)
+        await self.stream_file_i18n(f'door_opened_{door_id}')
+        return True
+
+    async def use_user_locale(self, lookups: BackendLookups):
+        """
+        Play the prompts in the user's locale, or in the default one if it can't be looked up.
+        """
+        try:
+            self.user_locale = await lookups.user_locale()
+        except ValueError as e:
+            await self.verbose('Getting the locale failed for %r - %r' % (self.phone_number, e))
+
+    async def prefetch(self):
+        """
+        Fetch the auth token (unless it is cached), the doors and the locale of the phone number into the caches.
+
+        :raises ValueError: on any exception
+        """
+        self.backend_auth_token = await self.get_auth_token()
+        if self.backend_auth_token is None:
             return
+        await self.call_cache(doors_cache.set, self.backend_auth_token, await self.fetch_doors())
+        await self.call_cache(user_locale_cache.set, self.backend_auth_token, await self.fetch_user_locale(),
+                              self.config.getfloat('cache', 'user_locale_ttl', fallback=3600))
+
+
+class BlockingDoorManager(AbstractDoorManager, AGI):
+    """
+    The I/O layer of the AGI script and of the threaded FastAGI server (``--serve``) - pyst2's AGI on the standard
+    streams or a FastAGI connection, the ``[http] client`` session and the backend thread pool. Every primitive
+    blocks, so the call flow runs to the end in the call's thread - see ``run_sync``.
+    """
+
+    def __init__(self, config: configparser.ConfigParser, phone_number: typing.Optional[str] = None,
+                 agi_env: typing.Optional[typing.Dict[str, str]] = None,
+                 stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+        if agi_env is None:
+            AGI.__init__(self, stdin=stdin, stdout=stdout, stderr=stderr)
+        else:
+            # FastAGI - the environment has already been read by the server and AGI.__init__
+            # can't install its SIGHUP handler outside the main thread
+            self.stdin = stdin
+            self.stdout = stdout
+            self.stderr = stderr
+            self._got_sighup = False
+            self.env = agi_env
+        super().__init__(config, phone_number)
+
+    def run_phone_call(self):
+        """
+        Handle the call to the end in the current thread.
+        """
+        run_sync(self.handle_and_record_phone_call())
+
+    @property
+    def backend_errors(self) -> typing.Tuple[typing.Type[Exception], ...]:
+        return door_ivr_backend.backend_errors
+
+    @property
+    def backend_outage_errors(self) -> typing.Tuple[typing.Type[Exception], ...]:
+        return door_ivr_backend.backend_outage_errors
+
+    @property
+    def http(self) -> typing.Union['requests.Session', HTTPClientSession]:
+        """
+        The process-wide HTTP session - created on the first backend request, so the HTTP client library
+        is imported in a backend lookup thread while the call is being answered.
+        """
+        return get_http_session(self.config)
+
+    async def send_line(self, line: str):
+        self.test_hangup()
+        try:
+            self.send_command(line)
+        except IOError as exc:
+            if exc.errno == errno.EPIPE:
+                raise AGISIGPIPEHangup("Received SIGPIPE")
+            raise
+
+    async def read_line(self) -> str:
+        line = self.stdin.readline()
+        self.stderr.write('    RESULT_LINE: %s\n' % line.strip())
+        if not line:
+            raise AGIHangup('Connection closed by Asterisk')
+        return line.strip()
+
+    async def get_result(self) -> typing.Dict[str, typing.Tuple[str, str]]:
+        result = await super().get_result()
+        self.stderr.write('    RESULT_DICT: %s\n' % pprint.pformat(result))
+        return result
+
+    async def send_request(self, method: str, url: str, timeout: typing.Tuple[float, float],
+                           data: typing.Optional[dict] = None,
+                           headers: typing.Optional[typing.Dict[str, str]] = None) -> typing.Tuple[int, bytes]:
+        response = self.http.request(method, url, data=data, headers=headers, timeout=timeout)
+        return response.status_code, response.content
+
+    async def run_blocking(self, function: typing.Callable, *args):
+        return function(*args)
+
+    def spawn(self, coroutine: typing.Coroutine, urgent: bool = False) -> concurrent.futures.Future:
+        if urgent:
+            return submit_to_daemon_thread(run_sync, coroutine)
+        return get_backend_executor(self.config).submit(run_sync, coroutine)
+
+    def resolved(self, value) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        future.set_result(value)
+        return future
+
+    async def wait_for_result(self, future: concurrent.futures.Future, timeout: typing.Optional[float] = None):
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as exc:
+            raise TimeoutError(f'No result within {timeout}s') from exc
+
+    async def wait_first(self, futures: typing.Iterable[concurrent.futures.Future],
+                         timeout: typing.Optional[float]) -> typing.Set[concurrent.futures.Future]:
+        return concurrent.futures.wait(futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+
+    def detach(self, future: concurrent.futures.Future):
+        pass  # a thread runs to the end anyway
+
+    async def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    async def run_concurrently(self, coroutines: typing.List[typing.Coroutine], limit: int) -> list:
+        if not coroutines:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(coroutines), limit),
+                                                   thread_name_prefix='concurrent') as executor:
+            futures = [executor.submit(run_sync, coroutine) for coroutine in coroutines]
+        return [future.exception() or future.result() for future in futures]
+
+
+class BlockingExternalPhoneDoorManager(ExternalPhoneDoorManager, BlockingDoorManager):
+    pass
+
+
+class BlockingPayphoneDoorManager(PayphoneDoorManager, BlockingDoorManager):
+    pass
+
+
+class BlockingInternalPhoneDoorManager(InternalPhoneDoorManager, BlockingDoorManager):
+    pass
+
+
+class BlockingInCallDoorManager(InCallDoorManager, BlockingDoorManager):
+    pass
+
+
+def start_in_call_prefetch(config: configparser.ConfigParser) -> typing.Optional[threading.Thread]:
+    """
+    Refresh the cached auth tokens, doors and locales of the internal phones every ``[in_call] prefetch_interval``
+    seconds in a daemon thread, so their feature keys (see ``InCallDoorManager``) cost a single backend request.
+    Only useful in server mode.
+    """
+    interval = config.getfloat('in_call', 'prefetch_interval', fallback=50)
+    if not interval or not config.has_section('internal_phones_mapping'):
+        return None
+
+    def prefetch_forever():
+        while True:
+            for phone_number in sorted(set(config['internal_phones_mapping'].values())):
+                try:
+                    run_sync(BlockingInCallDoorManager(config, phone_number=phone_number, agi_env={}).prefetch())
+                except ValueError as exc:
+                    sys.stderr.write('Prefetching the lookups of %r failed - %r\n' % (phone_number, exc))
+            time.sleep(interval)
+
+    thread = threading.Thread(target=prefetch_forever, name='in-call-prefetch', daemon=True)
+    thread.start()
+    return thread
+
 
-        self.stream_file_i18n(f'door_opened_{door_id}')
+DOOR_MANAGER_CLASSES = {
+    'external': BlockingExternalPhoneDoorManager,
+    'payphone': BlockingPayphoneDoorManager,
+    'internal': BlockingInternalPhoneDoorManager,
+    'in-call': BlockingInCallDoorManager,
+}
 
 
 def main():
     parser = argparse.ArgumentParser(description='init Lab door IVR AGI script')
     parser.add_argument('--config', help='location of the configuration file', required=True)
-    parser.add_argument('--handler', choices=['external', 'payphone', 'internal', 'in-call'],
-                        help='handler to use - one of %(choices)s',
-                        required=True)
+    parser.add_argument('--handler', choices=list(DOOR_MANAGER_CLASSES),
+                        help='handler to use - one of %(choices)s (required unless --serve is used)')
     parser.add_argument('--phone', help='phone number (default to getting it from caller id)', default=None)
+    parser.add_argument('--serve', action='store_true',
+                        help='run a long-lived FastAGI server, the handler is selected by the request path')
+    parser.add_argument('--host', help='FastAGI server address (default %(default)s)', default='127.0.0.1')
+    parser.add_argument('--port', help='FastAGI server port (default %(default)s)', type=int,
+                        default=FASTAGI_DEFAULT_PORT)
+    parser.add_argument('--build-assets', action='store_true',
+                        help='convert the prompts to the [assets] formats and write their manifest, then verify them')
+    parser.add_argument('--verify-assets', action='store_true',
+                        help='check that all the prompts exist in the [assets] formats and that their manifest is '
+                             'up to date')
     args = parser.parse_args()
-    door_manager_class = {
-        'external': ExternalPhoneDoorManager,
-        'payphone': PayphoneDoorManager,
-        'internal': InternalPhoneDoorManager,
-        'in-call': InCallDoorManager,
-    }[args.handler]
-    assert issubclass(door_manager_class, AbstractDoorManager)
-    door_manager = door_manager_class(phone_number=args.phone, config_filename=args.config)
-    door_manager.handle_phone_call()
+    config_load_started_at = time.monotonic()
+    config = load_config(args.config)
+    configure_caches(config)
+    config_load_duration = time.monotonic() - config_load_started_at
+
+    if args.build_assets or args.verify_assets:
+        sounds_path = get_sounds_path()
+        problems = build_assets(config, sounds_path) if args.build_assets else verify_assets(config, sounds_path)
+        for problem in problems:
+            sys.stderr.write(problem + '\n')
+        sys.exit(1 if problems else 0)
+
+    if args.serve:
+        get_asset_manifest(config)
+        start_metrics_server(config)
+        start_in_call_prefetch(config)
+        start_door_status_subscription(config)
+        with FastAGIServer((args.host, args.port), config, DOOR_MANAGER_CLASSES) as server:
+            sys.stderr.write('FastAGI server listening on agi://%s:%s/\n' % (args.host, args.port))
+            server.serve_forever()
+        return
+
+    if not args.handler:
+        parser.error('--handler is required unless --serve, --build-assets or --verify-assets is used')
+
+    door_manager_class = DOOR_MANAGER_CLASSES[args.handler]
+    assert issubclass(door_manager_class, BlockingDoorManager)
+    door_manager = door_manager_class(phone_number=args.phone, config=config)
+    door_manager.timings.record('config_load', config_load_duration)
+    door_manager.run_phone_call()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,402 @@
+"""
+Prompt assets of the door IVR - the joined door menu prompts, the asset manifest and ``door_ivr.py --build-assets``
+"""
+import configparser
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+# guards the creation of the process-wide prompt compositor and asset manifest
+_shared_resources_lock = threading.Lock()
+
+_MISSING = object()
+
+
+# headerless audio formats Asterisk plays by file extension - joined by concatenating the files
+RAW_AUDIO_FORMATS = ('sln', 'sln16', 'sln48', 'ulaw', 'alaw', 'gsm', 'g722')
+# RIFF/WAVE audio formats - joined by concatenating their frames
+WAVE_AUDIO_FORMATS = ('wav', 'wav16')
+
+
+class PromptCompositor:
+    """
+    Join prompts which are played back to back (e.g. the door menu) into a single file in every audio format they
+    all exist in, so they are played with one STREAM FILE and without the gaps between the files.
+
+    The joined files are cached in ``cache_dir`` under a name derived from the prompts and their modification times.
+    Older versions are removed when a prompt changes and files unused for ``max_age`` seconds are evicted. The formats
+    and modification times come from the ``manifest`` of the assets if it has the prompt.
+    """
+
+    def __init__(self, cache_dir: Path, max_age: float, manifest: typing.Optional['AssetManifest'] = None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.manifest = manifest
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_formats(prompt: Path) -> typing.Dict[str, int]:
+        """
+        Return the modification times (in ns) of the files of a prompt (a path without extension) by audio format.
+        """
+        formats = {}
+        for audio_format in RAW_AUDIO_FORMATS + WAVE_AUDIO_FORMATS:
+            try:
+                formats[audio_format] = os.stat(f'{prompt}.{audio_format}').st_mtime_ns
+            except OSError:
+                pass
+        return formats
+
+    def compose(self, name: str, prompts: typing.List[Path]) -> typing.Optional[Path]:
+        """
+        Return the joined ``prompts``, building them on first use.
+
+        :param name: the name of the joined file without the key suffix, unique for the list of prompts
+        :return: a path without extension (like the prompts) or None if the prompts don't exist in a common format
+        """
+        import zlib
+
+        prompts_formats = [
+            (self.manifest.get_formats(prompt) if self.manifest else None) or self.get_formats(prompt)
+            for prompt in prompts
+        ]
+        common_formats = sorted(set.intersection(*(set(formats) for formats in prompts_formats))) if prompts else []
+        if not common_formats:
+            return None
+
+        key = zlib.crc32(repr([
+            (str(prompt), [formats[audio_format] for audio_format in common_formats])
+            for prompt, formats in zip(prompts, prompts_formats)
+        ]).encode('utf-8'))
+        path = self.cache_dir.joinpath(f'{name}--{key:08x}')
+
+        with self._lock:
+            joined_formats = []
+            for audio_format in common_formats:
+                joined_file = f'{path}.{audio_format}'
+                try:
+                    os.utime(joined_file)  # used now - see evict()
+                except FileNotFoundError:
+                    try:
+                        self.cache_dir.mkdir(parents=True, exist_ok=True)
+                        self.join(prompts, audio_format, joined_file)
+                        self.evict(name, path)
+                    except Exception as exc:
+                        sys.stderr.write('Joining %s.%s failed - %r\n' % (path, audio_format, exc))
+                        continue
+                joined_formats.append(audio_format)
+        return path if joined_formats else None
+
+    @staticmethod
+    def join(prompts: typing.List[Path], audio_format: str, joined_file: str):
+        import shutil
+
+        # written next to the joined file and renamed, so no process plays a partially written file
+        temp_file = f'{joined_file}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            if audio_format in WAVE_AUDIO_FORMATS:
+                import wave
+
+                with wave.open(temp_file, 'wb') as output:
+                    for index, prompt in enumerate(prompts):
+                        with wave.open(f'{prompt}.{audio_format}', 'rb') as part:
+                            if index == 0:
+                                output.setparams(part.getparams())
+                            elif part.getparams()[:3] != output.getparams()[:3]:
+                                raise ValueError(f'{prompt}.{audio_format} has different channels, sample width '
+                                                 f'or frame rate than {prompts[0]}.{audio_format}')
+                            output.writeframes(part.readframes(part.getnframes()))
+            else:
+                with open(temp_file, 'wb') as output:
+                    for prompt in prompts:
+                        with open(f'{prompt}.{audio_format}', 'rb') as part:
+                            shutil.copyfileobj(part, output)
+            os.replace(temp_file, joined_file)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_file)
+
+    def evict(self, name: str, path: Path):
+        """
+        Remove the older versions of ``name`` and every file unused for ``max_age`` seconds.
+        """
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            stem = entry.name.partition('.')[0]
+            outdated = stem.rpartition('--')[0] == name and stem != path.name
+            with contextlib.suppress(OSError):
+                if outdated or now - entry.stat().st_mtime > self.max_age:
+                    os.unlink(entry.path)
+
+
+# prompts the handlers play from the locale directories of the assets - {door} stands for the door numbers
+LOCALE_PROMPTS = (
+    'welcome', 'goodbye', 'enter_pin', 'wrong_pin', 'enter_phone', 'wrong_selection', 'insufficient_permissions',
+    'service_unavailable', 'redirecting_to_public_phone', 'action_unsuccessful', 'door_locked', 'lock_failed',
+    'doors_unlocked', 'door_prompt_{door}', 'door_opened_{door}', 'door_prompt_9',
+)
+# prompts the handlers play from the root of the assets
+ASSET_PROMPTS = ('waiting_on_input',)
+# audio formats the prompts are converted from, best first
+SOURCE_AUDIO_FORMATS = ('sln48', 'wav16', 'sln16', 'wav', 'sln', 'g722', 'ulaw', 'alaw', 'gsm')
+
+
+class AssetManifest:
+    """
+    The audio formats (and their modification times in ns) of every prompt of the assets by its path relative to
+    ``sounds_path`` without extension, as written by ``build_assets()``. Loaded once per process, so finding the
+    locale of a prompt and its formats (see ``PromptCompositor``) doesn't probe the filesystem during calls.
+
+    ``sources`` has the format of the original file every prompt was converted from, so a rebuild converts from it
+    again instead of from a better format it generated.
+    """
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, sounds_path: Path, prompts: typing.Dict[str, typing.Dict[str, int]], fallback_locale: str,
+                 sources: typing.Optional[typing.Dict[str, str]] = None):
+        self.sounds_path = sounds_path
+        self.prompts = prompts
+        self.fallback_locale = fallback_locale
+        self.sources = sources or {}
+
+    @classmethod
+    def load(cls, sounds_path: Path, fallback_locale: str) -> typing.Optional['AssetManifest']:
+        """
+        :return: the manifest in ``sounds_path`` or None if there is none or it can't be read
+        """
+        try:
+            with open(sounds_path.joinpath(cls.FILENAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+            prompts, sources = manifest['prompts'], manifest.get('sources', {})
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            sys.stderr.write('Ignoring the asset manifest in %s - %r\n' % (sounds_path, exc))
+            return None
+        return cls(sounds_path, prompts, fallback_locale, sources)
+
+    @classmethod
+    def write(cls, sounds_path: Path, names: typing.Iterable[str], sources: typing.Dict[str, str]):
+        """
+        Write the manifest of the prompts ``names`` with the formats they exist in now and the ``sources`` they were
+        converted from.
+        """
+        prompts = {}
+        for name in names:
+            formats = PromptCompositor.get_formats(sounds_path.joinpath(name))
+            if formats:
+                prompts[name] = formats
+        sources = {name: source_format for name, source_format in sources.items() if name in prompts}
+        manifest_file = sounds_path.joinpath(cls.FILENAME)
+        temp_file = f'{manifest_file}.{os.getpid()}.tmp'
+        try:
+            with open(temp_file, 'w') as output:
+                json.dump({'prompts': prompts, 'sources': sources}, output, indent=1, sort_keys=True)
+            os.replace(temp_file, manifest_file)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_file)
+
+    def get_formats(self, prompt: Path) -> typing.Optional[typing.Dict[str, int]]:
+        """
+        :return: like ``PromptCompositor.get_formats`` or None if the prompt is not in the manifest
+        """
+        try:
+            return self.prompts.get(prompt.relative_to(self.sounds_path).as_posix())
+        except ValueError:  # not an asset
+            return None
+
+    def get_original_formats(self, name: str, existing_formats: typing.Dict[str, int]) -> typing.Set[str]:
+        """
+        Return the formats of the prompt ``name`` (see ``PromptCompositor.get_formats`` for ``existing_formats``)
+        which were not converted by ``build_assets()``: its source and the files which are new or changed since.
+        """
+        source_format = self.sources.get(name)
+        if source_format is None:
+            return set(existing_formats)
+        converted_formats = self.prompts.get(name, {})
+        return {
+            audio_format for audio_format, mtime in existing_formats.items()
+            if audio_format == source_format or converted_formats.get(audio_format) != mtime
+        }
+
+    def localize(self, locale: str, name: str) -> Path:
+        """
+        Return the prompt ``name`` of ``locale`` relative to ``sounds_path`` - of the fallback locale if ``locale``
+        doesn't have it.
+        """
+        if f'{locale}/{name}' not in self.prompts and f'{self.fallback_locale}/{name}' in self.prompts:
+            locale = self.fallback_locale
+        return Path(locale, name)
+
+
+def localize_prompt(manifest: typing.Optional[AssetManifest], locale: str, name: str) -> Path:
+    """
+    Return the prompt ``name`` of ``locale`` relative to the sounds path - see ``AssetManifest.localize``.
+    """
+    return Path(locale, name) if manifest is None else manifest.localize(locale, name)
+
+
+def get_sounds_path() -> Path:
+    return Path.cwd().joinpath('initlab-telephony-assets', 'files')
+
+
+def list_asset_prompts(config: configparser.ConfigParser, sounds_path: Path) -> typing.List[str]:
+    """
+    Return the paths (relative to ``sounds_path``, without extension) of all the prompts the handlers play, in every
+    ``[assets] locales`` (all the directories of ``sounds_path`` by default).
+    """
+    door_numbers = [number.strip() for number in config.get('assets', 'door_numbers', fallback='1-8').split(',')]
+    door_numbers = [
+        str(door_number) for numbers in door_numbers
+        for door_number in range(int(numbers.partition('-')[0]), int(numbers.rpartition('-')[2]) + 1)
+    ]
+    locales = config.get('assets', 'locales', fallback='').split()
+    if not locales:
+        locales = sorted(entry.name for entry in os.scandir(sounds_path) if entry.is_dir())
+
+    names = []
+    for locale in locales:
+        for prompt in LOCALE_PROMPTS:
+            names += sorted({f'{locale}/{prompt.format(door=door_number)}' for door_number in door_numbers})
+    return names + list(ASSET_PROMPTS)
+
+
+def build_assets(config: configparser.ConfigParser, sounds_path: Path) -> typing.List[str]:
+    """
+    Convert every prompt the handlers play from its best original file (see ``SOURCE_AUDIO_FORMATS``) to the
+    ``[assets] formats`` it is missing in or which are older, with ``[assets] convert_command``, so Asterisk doesn't
+    transcode it on every playback. Then write the ``AssetManifest`` and verify the assets.
+
+    The originals are the files the previous build's manifest doesn't list as converted (all of them on the first
+    build). They are never written, so building again converts from the same originals.
+
+    :return: the problems found - see ``verify_assets``
+    """
+    import shlex
+    import subprocess
+
+    formats = config.get('assets', 'formats', fallback='ulaw alaw g722 sln').split()
+    command = shlex.split(config.get('assets', 'convert_command',
+                                     fallback='asterisk -rx "file convert {source} {target}"'))
+    names = list_asset_prompts(config, sounds_path)
+    manifest = AssetManifest.load(sounds_path, config.get('assets', 'fallback_locale', fallback='bg')) \
+        or AssetManifest(sounds_path, {}, '')
+
+    problems = []
+    sources = {}
+    for name in names:
+        prompt = sounds_path.joinpath(name)
+        existing_formats = PromptCompositor.get_formats(prompt)
+        original_formats = manifest.get_original_formats(name, existing_formats)
+        source_format = next((format for format in SOURCE_AUDIO_FORMATS if format in original_formats), None)
+        if source_format is None:
+            continue  # missing - reported by verify_assets
+        sources[name] = source_format
+        for audio_format in formats:
+            if audio_format in original_formats \
+                    or existing_formats.get(audio_format, -1) >= existing_formats[source_format]:
+                continue
+            source, target = f'{prompt}.{source_format}', f'{prompt}.{audio_format}'
+            try:
+                subprocess.run([arg.format(source=source, target=target, format=audio_format) for arg in command],
+                               check=True, capture_output=True, timeout=60)
+                # asterisk -rx exits with 0 even if the conversion failed
+                if os.stat(target).st_mtime_ns < existing_formats[source_format]:
+                    raise FileNotFoundError(f'{target} was not written')
+            except (OSError, subprocess.SubprocessError) as exc:
+                problems.append(f'Converting {source} to {audio_format} failed - {exc!r}')
+
+    AssetManifest.write(sounds_path, names, sources)
+    return problems + verify_assets(config, sounds_path)
+
+
+def verify_assets(config: configparser.ConfigParser, sounds_path: Path) -> typing.List[str]:
+    """
+    Check that all the prompts the handlers play exist in all the ``[assets] formats`` and that the manifest is up
+    to date.
+
+    :return: the problems found, empty if there are none
+    """
+    formats = config.get('assets', 'formats', fallback='ulaw alaw g722 sln').split()
+    fallback_locale = config.get('assets', 'fallback_locale', fallback='bg')
+    manifest = AssetManifest.load(sounds_path, fallback_locale)
+    if manifest is None:
+        return [f'There is no asset manifest in {sounds_path} - build the assets with --build-assets']
+
+    problems = []
+    for name in list_asset_prompts(config, sounds_path):
+        prompt = sounds_path.joinpath(name)
+        existing_formats = PromptCompositor.get_formats(prompt)
+        if not existing_formats:
+            locale, _, filename = name.rpartition('/')
+            fallback = manifest.localize(locale, filename) if locale else None
+            if fallback is not None and fallback.parent.name != locale:
+                problems.append(f'{prompt} is missing - the {fallback} prompt is played instead')
+            else:
+                problems.append(f'{prompt} is missing')
+            continue
+        missing_formats = [audio_format for audio_format in formats if audio_format not in existing_formats]
+        if missing_formats:
+            problems.append(f"{prompt} is missing in {', '.join(missing_formats)}")
+        if manifest.prompts.get(name) != existing_formats or name not in manifest.sources:
+            problems.append(f'The asset manifest is outdated for {prompt} - build the assets with --build-assets')
+    return problems
+
+
+_prompt_compositor: typing.Optional[PromptCompositor] = None
+
+
+def get_prompt_compositor(config: configparser.ConfigParser) -> typing.Optional[PromptCompositor]:
+    """
+    Return the process-wide prompt compositor caching in ``[prompts] cache_dir`` (relative to the working directory,
+    like the assets), creating it on first use, or None if ``cache_dir`` is empty.
+    """
+    global _prompt_compositor
+    cache_dir = config.get('prompts', 'cache_dir', fallback='initlab-telephony-prompt-cache')
+    if not cache_dir:
+        return None
+    manifest = get_asset_manifest(config)
+    with _shared_resources_lock:
+        if _prompt_compositor is None:
+            _prompt_compositor = PromptCompositor(
+                Path.cwd().joinpath(cache_dir),
+                max_age=config.getfloat('prompts', 'cache_max_age', fallback=7 * 24 * 3600),
+                manifest=manifest,
+            )
+        return _prompt_compositor
+
+
+_asset_manifest: typing.Union[AssetManifest, None, object] = _MISSING
+
+
+def get_asset_manifest(config: configparser.ConfigParser) -> typing.Optional[AssetManifest]:
+    """
+    Return the process-wide manifest of the assets, loading it on first use, or None if the assets have none -
+    then the prompts are looked up on the filesystem and not localized to the ``[assets] fallback_locale``.
+    """
+    global _asset_manifest
+    with _shared_resources_lock:
+        if _asset_manifest is _MISSING:
+            _asset_manifest = AssetManifest.load(get_sounds_path(),
+                                                 config.get('assets', 'fallback_locale', fallback='bg'))
+        return _asset_manifest
+
+
+def get_door_menu_prompts(sounds_path: Path, locale: str, door_action_choices: typing.List[str],
+                          manifest: typing.Optional[AssetManifest] = None) -> typing.List[Path]:
+    """
+    Return the prompts of the door menu - one per choice. The long ``waiting_on_input`` after them is played on its
+    own, so it isn't copied into the joined file of every menu.
+    """
+    return [
+        sounds_path.joinpath(localize_prompt(manifest, locale, 'door_prompt_' + door_number))
+        for door_number in door_action_choices
+    ]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+init Lab door IVR FastAGI server running on asyncio
+
+The handler flows of ``door_ivr.py`` run as coroutines on a single event loop, so one process serves many
+concurrent channels without a thread per caller. The caches (``door_ivr_caches.py``) and circuit breakers
+(``door_ivr_backend.py``) are shared. The per-call AGI script and the threaded ``door_ivr.py --serve`` stay available.
+"""
+import argparse
+import asyncio
+import configparser
+import sys
+import typing
+
+import aiohttp
+
+from asterisk.agi import AGIHangup
+
+from door_ivr import AbstractDoorManager, ExternalPhoneDoorManager, InCallDoorManager, InternalPhoneDoorManager, \
+    PayphoneDoorManager, load_config
+from door_ivr_assets import get_asset_manifest
+from door_ivr_backend import BackendConnectionError, BackendRequestError, start_door_status_subscription
+from door_ivr_caches import configure_caches
+from door_ivr_metrics import start_metrics_server
+from door_ivr_server import FASTAGI_DEFAULT_PORT
+
+# errors of backend requests - the ones door_ivr_backend.py raises itself (BackendHTTPError, BackendUnavailableError,
+# ...) are BackendRequestErrors
+BACKEND_ERRORS = (BackendRequestError, aiohttp.ClientError, asyncio.TimeoutError)
+# the ones of them raised when the backend is down or slow, like door_ivr_backend.backend_outage_errors
+BACKEND_OUTAGE_ERRORS = (BackendConnectionError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+# the tasks nobody awaits right away - the event loop only keeps weak references to them
+_background_tasks: typing.Set[asyncio.Task] = set()
+
+
+def create_background_task(coroutine: typing.Coroutine) -> asyncio.Task:
+    """
+    Run a coroutine in a task which is referenced until it is done, so it can't be garbage collected before.
+    """
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+class AsyncDoorManager(AbstractDoorManager):
+    """
+    The I/O layer of the asyncio FastAGI server - asyncio streams, the server's aiohttp session and tasks. The call
+    flow is ``door_ivr.AbstractDoorManager``'s.
+    """
+    backend_errors = BACKEND_ERRORS
+    backend_outage_errors = BACKEND_OUTAGE_ERRORS
+
+    def __init__(self, config: configparser.ConfigParser, http: aiohttp.ClientSession,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter, env: typing.Dict[str, str],
+                 phone_number: typing.Optional[str] = None):
+        self.http = http
+        self.reader = reader
+        self.writer = writer
+        self.env = env
+        super().__init__(config, phone_number)
+
+    async def send_line(self, line: str):
+        self.writer.write(line.encode('utf-8') + b'\n')
+        await self.writer.drain()
+
+    async def read_line(self) -> str:
+        line = await self.reader.readline()
+        if not line:
+            raise AGIHangup('Connection closed by Asterisk')
+        return line.decode('utf-8').strip()
+
+    async def send_request(self, method: str, url: str, timeout: typing.Tuple[float, float],
+                           data: typing.Optional[dict] = None,
+                           headers: typing.Optional[typing.Dict[str, str]] = None) -> typing.Tuple[int, bytes]:
+        connect_timeout, read_timeout = timeout
+        async with self.http.request(method, url, data=data, headers=headers,
+                                     timeout=aiohttp.ClientTimeout(connect=connect_timeout,
+                                                                   sock_read=read_timeout)) as response:
+            return response.status, await response.read()
+
+    async def run_blocking(self, function: typing.Callable, *args):
+        return await asyncio.to_thread(function, *args)
+
+    def spawn(self, coroutine: typing.Coroutine, urgent: bool = False) -> asyncio.Task:
+        return create_background_task(coroutine)
+
+    def resolved(self, value) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        return future
+
+    async def wait_for_result(self, future: asyncio.Future, timeout: typing.Optional[float] = None):
+        if timeout is None:
+            return await future
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError as exc:
+            raise TimeoutError(f'No result within {timeout}s') from exc
+
+    async def wait_first(self, futures: typing.Iterable[asyncio.Future],
+                         timeout: typing.Optional[float]) -> typing.Set[asyncio.Future]:
+        return (await asyncio.wait(futures, timeout=timeout, return_when=asyncio.FIRST_COMPLETED))[0]
+
+    def detach(self, future: asyncio.Future):
+        future.add_done_callback(lambda future: future.exception())
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def run_concurrently(self, coroutines: typing.List[typing.Coroutine], limit: int) -> list:
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+
+class AsyncExternalPhoneDoorManager(ExternalPhoneDoorManager, AsyncDoorManager):
+    pass
+
+
+class AsyncPayphoneDoorManager(PayphoneDoorManager, AsyncDoorManager):
+    pass
+
+
+class AsyncInternalPhoneDoorManager(InternalPhoneDoorManager, AsyncDoorManager):
+    pass
+
+
+class AsyncInCallDoorManager(InCallDoorManager, AsyncDoorManager):
+    pass
+
+
+ASYNC_DOOR_MANAGER_CLASSES = {
+    'external': AsyncExternalPhoneDoorManager,
+    'payphone': AsyncPayphoneDoorManager,
+    'internal': AsyncInternalPhoneDoorManager,
+    'in-call': AsyncInCallDoorManager,
+}
+
+
+async def read_agi_env(reader: asyncio.StreamReader) -> typing.Dict[str, str]:
+    """
+    Coroutine version of ``door_ivr_server.read_agi_env``.
+    """
+    env = {}
+    while True:
+        line = (await reader.readline()).decode('utf-8').strip()
+        if line == '':
+            break
+        key, _, data = line.partition(':')
+        if key.strip():
+            env[key.strip()] = data.strip()
+    return env
+
+
+class AsyncFastAGIServer:
+    """
+    FastAGI server running every channel as a task on one event loop, e.g. ``AGI(agi://127.0.0.1:4573/in-call,1)``.
+
+    The request path selects the handler and the first AGI argument is used as ``--phone``.
+    """
+
+    def __init__(self, config: configparser.ConfigParser):
+        self.config = config
+        self.http: typing.Optional[aiohttp.ClientSession] = None
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        try:
+            env = await read_agi_env(reader)
+            handler = env.get('agi_network_script', '').strip('/').split('?')[0]
+            door_manager_class = ASYNC_DOOR_MANAGER_CLASSES.get(handler)
+            if door_manager_class is None:
+                sys.stderr.write('Unknown FastAGI handler %r from %s\n' % (handler, peer))
+                return
+            door_manager = door_manager_class(config=self.config, http=self.http, reader=reader, writer=writer,
+                                              env=env, phone_number=env.get('agi_arg_1') or None)
+            await door_manager.handle_and_record_phone_call()
+        except AGIHangup:
+            pass  # the caller hung up - nothing more to do
+        except Exception as exc:
+            sys.stderr.write('Error handling FastAGI request from %s - %r\n' % (peer, exc))
+        finally:
+            writer.close()
+
+    async def prefetch_internal_phones(self, interval: float):
+        """
+        Task version of ``door_ivr.start_in_call_prefetch``.
+        """
+        while True:
+            for phone_number in sorted(set(self.config['internal_phones_mapping'].values())):
+                door_manager = AsyncInCallDoorManager(config=self.config, http=self.http, reader=None, writer=None,
+                                                      env={}, phone_number=phone_number)
+                try:
+                    await door_manager.prefetch()
+                except ValueError as exc:
+                    sys.stderr.write('Prefetching the lookups of %r failed - %r\n' % (phone_number, exc))
+            await asyncio.sleep(interval)
+
+    async def serve(self, host: str, port: int):
+        connector = aiohttp.TCPConnector(
+            limit_per_host=self.config.getint('http', 'pool_maxsize', fallback=10),
+            force_close=not self.config.getboolean('http', 'keep_alive', fallback=True),
+        )
+        async with aiohttp.ClientSession(connector=connector) as self.http:
+            prefetch_interval = self.config.getfloat('in_call', 'prefetch_interval', fallback=50)
+            if prefetch_interval and self.config.has_section('internal_phones_mapping'):
+                create_background_task(self.prefetch_internal_phones(prefetch_interval))
+            server = await asyncio.start_server(self.handle_connection, host, port, reuse_address=True)
+            sys.stderr.write('asyncio FastAGI server listening on agi://%s:%s/\n' % (host, port))
+            async with server:
+                await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='init Lab door IVR FastAGI server running on asyncio')
+    parser.add_argument('--config', help='location of the configuration file', required=True)
+    parser.add_argument('--host', help='FastAGI server address (default %(default)s)', default='127.0.0.1')
+    parser.add_argument('--port', help='FastAGI server port (default %(default)s)', type=int,
+                        default=FASTAGI_DEFAULT_PORT)
+    args = parser.parse_args()
+    config = load_config(args.config)
+    configure_caches(config)
+    get_asset_manifest(config)
+    start_metrics_server(config)
+    start_door_status_subscription(config)
+    asyncio.run(AsyncFastAGIServer(config).serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
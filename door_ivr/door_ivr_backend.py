@@ -0,0 +1,639 @@
+"""
+Backend client of the door IVR - the HTTP sessions, timeouts, circuit breakers and thread pool of the requests to
+fauna and portier, the door action policy and the door status cache
+"""
+import collections
+import concurrent.futures
+import configparser
+import contextlib
+import datetime
+import json
+import random
+import select
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+if typing.TYPE_CHECKING:
+    # imported on first use only (see get_http_session) - slow to import and every call started by Asterisk's AGI()
+    # is a new process
+    import requests
+
+# guards the creation of the process-wide HTTP session, thread pool and circuit breakers
+_shared_resources_lock = threading.Lock()
+
+# door statuses - see DoorStatusCache
+DOOR_LOCKED = 'locked'
+DOOR_UNLOCKED = 'unlocked'
+
+
+class BackendRequestError(IOError):
+    """
+    A failed backend request of the ``http.client`` backend (see ``HTTPClientSession``),
+    the counterpart of ``requests.exceptions.RequestException``.
+    """
+
+
+class BackendConnectionError(BackendRequestError):
+    """
+    The backend could not be reached or did not answer in time.
+    """
+
+
+class BackendHTTPError(BackendRequestError):
+    """
+    The backend answered with a 4xx or 5xx ``status``.
+    """
+
+    def __init__(self, message: str, status: typing.Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class BackendUnavailableError(BackendConnectionError):
+    """
+    Raised instead of sending a request to a backend whose circuit breaker is open
+    or when the call's backend time budget is used up.
+    """
+
+
+# exception types of failed backend requests, requests.exceptions.RequestException is added
+# once the requests backend is loaded - see get_http_session
+backend_errors: typing.Tuple[typing.Type[Exception], ...] = (BackendRequestError,)
+
+# the ones of them raised when the backend is down or slow (5xx statuses aside) - see
+# door_ivr.AbstractDoorManager.is_backend_outage
+backend_outage_errors: typing.Tuple[typing.Type[Exception], ...] = (BackendConnectionError,)
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests to a backend after ``failure_threshold`` consecutive failures (connection errors, timeouts
+    and 5xx responses). After ``reset_timeout`` seconds a single trial request is let through - if it succeeds the
+    circuit is closed again, otherwise it stays open for another ``reset_timeout``.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+        self.trial_request_pending = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        :raises BackendUnavailableError: if the circuit is open
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.trial_request_pending or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise BackendUnavailableError(f"Circuit breaker for the {self.name} backend is open")
+            self.trial_request_pending = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_request_pending = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_request_pending or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_request_pending = False
+
+    def record_abandoned(self):
+        """
+        Forget a request which ended without an answer or a backend error (e.g. it was cancelled or the call hung
+        up), so an abandoned trial request doesn't keep the circuit open - the next request is the trial then.
+        """
+        with self._lock:
+            self.trial_request_pending = False
+
+
+_circuit_breakers: typing.Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(config: configparser.ConfigParser, backend: str) -> CircuitBreaker:
+    """
+    Return the process-wide circuit breaker of a backend (``auth`` or ``door``), creating it on first use.
+    """
+    with _shared_resources_lock:
+        if backend not in _circuit_breakers:
+            _circuit_breakers[backend] = CircuitBreaker(
+                backend,
+                failure_threshold=config.getint('timeouts', 'circuit_breaker_failures', fallback=3),
+                reset_timeout=config.getfloat('timeouts', 'circuit_breaker_reset', fallback=30),
+            )
+        return _circuit_breakers[backend]
+
+
+# door action responses worth another attempt - the request has an Idempotency-Key, so portier acts on it once
+DOOR_ACTION_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class DoorActionPolicy:
+    """
+    When to hedge and retry a door action (see ``door_ivr.AbstractDoorManager.perform_door_action``).
+
+    A hedged duplicate is sent once an attempt takes longer than the ``hedge_percentile`` of the latest ``window``
+    successful attempts of this process, or than ``hedge_after`` seconds while there are fewer than ``min_samples``
+    of them (always, if Asterisk starts a process per call). Failed attempts are retried up to ``retries`` times after
+    a random backoff of up to ``retry_backoff * 2 ** retry`` seconds ("full jitter").
+    """
+
+    def __init__(self, hedge_percentile: float, hedge_after: float, min_samples: int, window: int, retries: int,
+                 retry_backoff: float):
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._latencies: typing.Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> typing.Optional[float]:
+        """
+        :return: seconds after which to send a hedged duplicate of an attempt or None if hedging is disabled
+        """
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.hedge_after
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, self.retry_backoff * 2 ** retry)
+
+
+def submit_to_daemon_thread(function: typing.Callable, *args) -> concurrent.futures.Future:
+    """
+    Run ``function(*args)`` in a new daemon thread - unlike with a thread pool it never waits for a free worker,
+    and a process doesn't wait for it to finish on exit.
+    """
+    future = concurrent.futures.Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+_door_action_policy: typing.Optional[DoorActionPolicy] = None
+
+
+def get_door_action_policy(config: configparser.ConfigParser) -> DoorActionPolicy:
+    """
+    Return the process-wide ``DoorActionPolicy`` from the ``[door_action]`` section, creating it on first use.
+    """
+    global _door_action_policy
+    with _shared_resources_lock:
+        if _door_action_policy is None:
+            _door_action_policy = DoorActionPolicy(
+                hedge_percentile=config.getfloat('door_action', 'hedge_percentile', fallback=95),
+                hedge_after=config.getfloat('door_action', 'hedge_after', fallback=1),
+                min_samples=config.getint('door_action', 'hedge_min_samples', fallback=20),
+                window=config.getint('door_action', 'hedge_window', fallback=200),
+                retries=config.getint('door_action', 'retries', fallback=2),
+                retry_backoff=config.getfloat('door_action', 'retry_backoff', fallback=0.2),
+            )
+        return _door_action_policy
+
+
+def parse_backend_timestamp(value: str) -> datetime.datetime:
+    """
+    Parse a backend timestamp, e.g. ``2044-04-01T00:00:00.000Z``.
+    """
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def get_auth_token_ttl(config: configparser.ConfigParser, auth_token: dict) -> float:
+    """
+    Return for how many seconds the ``auth_token`` from phone_number_token can be cached,
+    0 for tokens without a known expiry.
+    """
+    try:
+        expires_in = (parse_backend_timestamp(auth_token['expires_at'])
+                      - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    except (KeyError, TypeError, ValueError):
+        return 0
+    return min(
+        expires_in - config.getfloat('cache', 'auth_token_expiry_margin', fallback=60),
+        config.getfloat('cache', 'auth_token_max_ttl', fallback=86400),
+    )
+
+
+def get_backend_timeout(config: configparser.ConfigParser, endpoint: str,
+                        budget: float) -> typing.Tuple[float, float]:
+    """
+    Return the ``(connect, read)`` timeouts of a backend endpoint from the ``[timeouts]`` section,
+    capped by the remaining backend time ``budget`` of the call.
+
+    :raises BackendUnavailableError: if the budget is used up
+    """
+    if budget <= 0:
+        raise BackendUnavailableError('The backend time budget of the call is used up')
+    return (
+        min(config.getfloat('timeouts', 'connect', fallback=3), budget),
+        min(config.getfloat('timeouts', endpoint, fallback=5), budget),
+    )
+
+
+class HTTPClientResponse:
+    """
+    The part of ``requests.Response`` used by the door managers.
+    """
+
+    def __init__(self, url: str, status_code: int, reason: str, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+
+
+class HTTPClientSession:
+    """
+    Stand-in for ``requests.Session`` built on the standard library's ``http.client`` (``[http] client``), which
+    imports in a fraction of the time ``requests`` does.
+
+    Keeps up to ``pool_maxsize`` idle keep-alive connections per backend host.
+    """
+
+    def __init__(self, pool_maxsize: int = 10, keep_alive: bool = True):
+        import http.client
+
+        self.connection_classes = {'http': http.client.HTTPConnection, 'https': http.client.HTTPSConnection}
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        # (scheme, host, port) -> idle connections
+        self._idle_connections = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key, connect_timeout: float):
+        with self._lock:
+            idle_connections = self._idle_connections[key]
+            while idle_connections:
+                connection = idle_connections.pop()
+                # an idle connection is only readable if the server closed it (or sent garbage)
+                if not select.select([connection.sock], [], [], 0)[0]:
+                    return connection
+                connection.close()
+        scheme, host, port = key
+        return self.connection_classes[scheme](host, port, timeout=connect_timeout)
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            idle_connections = self._idle_connections[key]
+            if len(idle_connections) < self.pool_maxsize:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, method: str, url: str, data: typing.Optional[dict] = None,
+                headers: typing.Optional[typing.Dict[str, str]] = None,
+                timeout: typing.Tuple[float, float] = (3, 5)) -> HTTPClientResponse:
+        """
+        Send a request with an optional form-encoded body and read the whole response.
+
+        :param timeout: ``(connect, read)`` timeouts in seconds, like ``requests``
+        :raises BackendConnectionError: on any network or protocol error
+        """
+        import http.client
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        connect_timeout, read_timeout = timeout
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        headers = dict(headers or {})
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+
+        connection = self._get_connection(key, connect_timeout)
+        try:
+            if connection.sock is None:
+                connection.connect()
+            connection.sock.settimeout(read_timeout)
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException) as exc:
+            connection.close()
+            raise BackendConnectionError(exc) from exc
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(key, connection)
+        return HTTPClientResponse(url, response.status, response.reason, content)
+
+
+def create_requests_session(config: configparser.ConfigParser) -> 'requests.Session':
+    global backend_errors, backend_outage_errors
+
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=config.getint('http', 'pool_connections', fallback=4),
+        pool_maxsize=config.getint('http', 'pool_maxsize', fallback=10),
+        pool_block=config.getboolean('http', 'pool_block', fallback=False),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not config.getboolean('http', 'keep_alive', fallback=True):
+        session.headers['Connection'] = 'close'
+    backend_errors = (BackendRequestError, requests.exceptions.RequestException)
+    backend_outage_errors = (BackendConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    return session
+
+
+_http_session: typing.Union['requests.Session', HTTPClientSession, None] = None
+
+
+def get_http_session(config: configparser.ConfigParser) -> typing.Union['requests.Session', HTTPClientSession]:
+    """
+    Return the process-wide HTTP session used for all backend requests, creating it on first use with the
+    ``[http] client`` library - ``requests`` or the standard library's ``http.client``.
+
+    The session keeps a pool of keep-alive connections per backend host, so a long-lived process
+    (see ``--serve``) reuses the TCP+TLS connections across calls.
+    """
+    global _http_session
+    with _shared_resources_lock:
+        if _http_session is None:
+            client = config.get('http', 'client', fallback='requests')
+            if client == 'requests':
+                _http_session = create_requests_session(config)
+            elif client == 'http.client':
+                _http_session = HTTPClientSession(
+                    pool_maxsize=config.getint('http', 'pool_maxsize', fallback=10),
+                    keep_alive=config.getboolean('http', 'keep_alive', fallback=True),
+                )
+            else:
+                raise ValueError(f"Unknown [http] client {client!r} - use requests or http.client")
+        return _http_session
+
+
+_backend_executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def get_backend_executor(config: configparser.ConfigParser) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Return the process-wide thread pool used to run backend requests in the background, creating it on first use.
+    """
+    global _backend_executor
+    with _shared_resources_lock:
+        if _backend_executor is None:
+            _backend_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.getint('http', 'request_workers', fallback=8),
+                thread_name_prefix='backend',
+            )
+        return _backend_executor
+
+
+class DoorStatusStreamUnsupported(BackendRequestError):
+    """
+    The door backend has no door status stream.
+    """
+
+
+class DoorStatusCache:
+    """
+    The statuses (``locked``/``unlocked``) of the lockable doors by door id, kept up to date by a daemon thread
+    subscribed to portier's ``doors/statuses/stream`` (server-sent events). While the stream is down it polls
+    ``doors/statuses`` every ``poll_interval`` seconds instead, and if portier has no stream it tries it again every
+    ``stream_retry`` seconds. Only worth it in a long-lived process - see ``start_door_status_subscription``.
+
+    The statuses are only used while the stream or a poll has answered within ``max_age`` seconds. A poll waits up
+    to ``poll_timeout`` seconds for portier, the stream up to ``stream_timeout`` seconds between its heartbeats.
+    """
+
+    # seconds between the polls of ``wait_for`` while the stream is down
+    WAIT_POLL_INTERVAL = 1
+
+    def __init__(self, door_api_url: str, token: str, max_age: float, poll_interval: float, stream_timeout: float,
+                 stream_retry: float, connect_timeout: float, poll_timeout: float):
+        self.url = urllib.parse.urlsplit(door_api_url)
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.stream_timeout = stream_timeout
+        self.stream_retry = stream_retry
+        self.connect_timeout = connect_timeout
+        self.poll_timeout = poll_timeout
+        self.statuses: typing.Dict[str, str] = {}
+        self.seen_at: typing.Optional[float] = None  # the last time the stream or a poll answered
+        self.streaming = False
+        self._changed = threading.Condition()
+
+    def is_live(self) -> bool:
+        seen_at = self.seen_at
+        return seen_at is not None and time.monotonic() - seen_at <= self.max_age
+
+    def get(self, door_id: str) -> typing.Optional[str]:
+        """
+        :return: the status of the door or None if it is unknown or outdated
+        """
+        if not self.is_live():
+            return None
+        with self._changed:
+            return self.statuses.get(door_id)
+
+    def wait_for(self, door_ids: typing.Iterable[str], status: str, timeout: float) -> typing.Dict[str, str]:
+        """
+        Wait up to ``timeout`` seconds for all the doors to have the ``status``, polling every
+        ``WAIT_POLL_INTERVAL`` seconds while the stream is down. The polls don't outlast the ``timeout`` either.
+
+        :return: the other statuses (None if unknown) of the doors which don't have it by then, by door id
+        """
+        door_ids = list(door_ids)
+        deadline = time.monotonic() + timeout
+
+        def other_statuses():
+            return {door_id: self.statuses.get(door_id) for door_id in door_ids if self.statuses.get(door_id) != status}
+
+        while True:
+            remaining = deadline - time.monotonic()
+            with self._changed:
+                self._changed.wait_for(lambda: not other_statuses(),
+                                       remaining if self.streaming else min(remaining, self.WAIT_POLL_INTERVAL))
+                statuses = other_statuses()
+            remaining = deadline - time.monotonic()
+            if not statuses or remaining <= 0:
+                return statuses
+            if not self.streaming:
+                self.poll_quietly(remaining)
+
+    def update(self, statuses: typing.Union[dict, typing.List[dict]], replace: bool = False):
+        """
+        Set the statuses of a list of ``{"id": ..., "status": ...}`` (or a single one), replacing all of them if
+        ``replace`` - a full list.
+        """
+        if isinstance(statuses, dict):
+            statuses = [statuses]
+        with self._changed:
+            if replace:
+                self.statuses.clear()
+            self.statuses.update((door_status['id'], door_status['status']) for door_status in statuses)
+            self.seen_at = time.monotonic()
+            self._changed.notify_all()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.subscribe_forever, name='door-status', daemon=True)
+        thread.start()
+        return thread
+
+    def subscribe_forever(self):
+        import http.client
+
+        failures = 0
+        while True:
+            try:
+                self.subscribe()
+                failures = 0
+                poll_for = self.poll_interval  # the stream ended - e.g. portier restarted
+            except DoorStatusStreamUnsupported:
+                poll_for = self.stream_retry
+            except (OSError, http.client.HTTPException, ValueError, KeyError, TypeError) as exc:
+                sys.stderr.write('The door status stream failed - %r\n' % exc)
+                failures += 1
+                poll_for = random.uniform(self.poll_interval, self.poll_interval * 2 ** min(failures, 6))
+            self.poll_until(time.monotonic() + poll_for)
+
+    def _request(self, path: str, timeout: float, headers: typing.Dict[str, str]):
+        """
+        :param timeout: the read timeout, which also bounds the connect timeout
+        """
+        import http.client
+
+        connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(self.url.hostname, self.url.port, timeout=min(self.connect_timeout, timeout))
+        try:
+            connection.connect()
+            connection.sock.settimeout(timeout)
+            connection.request('GET', f'{self.url.path}/{path}', headers={**self.headers, **headers})
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def subscribe(self):
+        """
+        Follow the door status stream until it ends.
+
+        :raises DoorStatusStreamUnsupported: if portier has no stream
+        """
+        connection, response = self._request('doors/statuses/stream', self.stream_timeout,
+                                             {'Accept': 'text/event-stream'})
+        with contextlib.closing(connection):
+            if response.status in (404, 405, 406, 501):
+                raise DoorStatusStreamUnsupported(f'{response.status} for the door status stream')
+            if response.status != 200:
+                raise BackendHTTPError(f'{response.status} {response.reason} for the door status stream',
+                                       response.status)
+            self.streaming = True
+            try:
+                self.follow(response)
+            finally:
+                self.streaming = False
+
+    def follow(self, response):
+        event, data = 'status', []
+        while line := response.readline():
+            self.seen_at = time.monotonic()  # comment lines are the heartbeats of the stream
+            line = line.decode('utf-8').rstrip('\r\n')
+            if not line:  # the end of an event - a snapshot of all the statuses or changed ones
+                if data:
+                    self.update(json.loads('\n'.join(data)), replace=event == 'snapshot')
+                event, data = 'status', []
+            elif not line.startswith(':'):
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'event':
+                    event = value
+                elif field == 'data':
+                    data.append(value)
+
+    def poll(self, timeout: typing.Optional[float] = None):
+        """
+        :param timeout: seconds to wait for portier at most, if less than ``poll_timeout``
+        """
+        timeout = self.poll_timeout if timeout is None else min(timeout, self.poll_timeout)
+        connection, response = self._request('doors/statuses', timeout, {'Accept': 'application/json'})
+        with contextlib.closing(connection):
+            if response.status != 200:
+                raise BackendHTTPError(f'{response.status} {response.reason} for the door statuses', response.status)
+            self.update(json.loads(response.read()), replace=True)
+
+    def poll_quietly(self, timeout: typing.Optional[float] = None):
+        import http.client
+
+        try:
+            self.poll(timeout)
+        except (OSError, http.client.HTTPException, ValueError, KeyError, TypeError) as exc:
+            sys.stderr.write('Polling the door statuses failed - %r\n' % exc)
+
+    def poll_until(self, deadline: float):
+        while True:
+            self.poll_quietly()
+            if time.monotonic() + self.poll_interval >= deadline:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return
+            time.sleep(self.poll_interval)
+
+
+_door_status_cache: typing.Optional[DoorStatusCache] = None
+
+
+def start_door_status_subscription(config: configparser.ConfigParser) -> typing.Optional[DoorStatusCache]:
+    """
+    Start keeping the door statuses in the process-wide ``DoorStatusCache`` if ``[door_status] token`` is set.
+    Only in server mode - a process per call would open a stream per call.
+    """
+    global _door_status_cache
+    token = config.get('door_status', 'token', fallback='')
+    if not token:
+        return None
+    with _shared_resources_lock:
+        if _door_status_cache is None:
+            _door_status_cache = DoorStatusCache(
+                config['backend']['door_api_url'], token,
+                max_age=config.getfloat('door_status', 'max_age', fallback=60),
+                poll_interval=config.getfloat('door_status', 'poll_interval', fallback=10),
+                stream_timeout=config.getfloat('door_status', 'stream_timeout', fallback=45),
+                stream_retry=config.getfloat('door_status', 'stream_retry', fallback=300),
+                connect_timeout=config.getfloat('timeouts', 'connect', fallback=3),
+                poll_timeout=config.getfloat('timeouts', 'door_statuses', fallback=5),
+            )
+            _door_status_cache.start()
+        return _door_status_cache
+
+
+def get_door_status_cache() -> typing.Optional[DoorStatusCache]:
+    """
+    Return the process-wide ``DoorStatusCache`` or None if it was not started - see
+    ``start_door_status_subscription``.
+    """
+    return _door_status_cache
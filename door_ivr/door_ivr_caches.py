@@ -0,0 +1,479 @@
+"""
+Process-wide caches of the door IVR and the stores shared by its processes - the in-memory and SQLite cache
+stores, the offline auth store and the feature key debounce
+"""
+import collections
+import configparser
+import contextlib
+import fcntl
+import json
+import os
+import re
+import sys
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+if typing.TYPE_CHECKING:
+    # imported on first use only (see SQLiteCacheStore) - every call started by Asterisk's AGI() is a new process
+    import sqlite3
+
+_MISSING = object()
+
+# guards the creation of the process-wide offline auth store
+_shared_resources_lock = threading.Lock()
+
+
+class MemoryCacheStore:
+    """
+    The entries of a cache in this process, as ``(stored_at, expires_at, value)`` - ``expires_at`` is None for
+    entries which don't expire. See ``SQLiteCacheStore`` for the entries shared by all the processes.
+    """
+
+    # whether the store waits for I/O - see door_ivr.AbstractDoorManager.call_cache
+    blocking = False
+
+    def __init__(self):
+        self._entries: typing.Dict[typing.Hashable, typing.Tuple[float, typing.Optional[float], typing.Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> typing.Optional[typing.Tuple[float, typing.Optional[float], typing.Any]]:
+        """
+        :return: the entry or None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            return entry
+
+    def set(self, key, value, expires_at: typing.Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (time.time(), expires_at, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class TTLCache:
+    """
+    Thread-safe cache where every entry has its own expiry time, kept in a ``MemoryCacheStore`` unless
+    ``configure_caches()`` changes the ``store``.
+    """
+
+    def __init__(self):
+        self.store: typing.Union[MemoryCacheStore, 'SQLiteCacheStore'] = MemoryCacheStore()
+
+    def get(self, key, default=None):
+        entry = self.store.get(key)
+        return default if entry is None else entry[2]
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0:
+            return
+        self.store.set(key, value, expires_at=time.time() + ttl)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+
+class StaleWhileRevalidateCache:
+    """
+    Thread-safe cache which keeps serving entries after they become stale, kept in a ``MemoryCacheStore`` unless
+    ``configure_caches()`` changes the ``store``.
+
+    Entries younger than ``ttl`` are returned as they are. Stale entries younger than ``max_stale`` are returned
+    right away and refreshed in the background by the caller - if the refresh fails the stale entry is kept.
+    Anything older is fetched while the caller waits.
+    """
+
+    def __init__(self):
+        self.store: typing.Union[MemoryCacheStore, 'SQLiteCacheStore'] = MemoryCacheStore()
+        self._refreshing: typing.Set[typing.Hashable] = set()
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()  # hits, misses, stale, refresh_errors
+
+    def lookup(self, key, ttl: float, max_stale: float) -> typing.Tuple[bool, typing.Any, bool]:
+        """
+        Look up ``key`` without fetching anything.
+
+        :return: ``(found, value, refresh)`` - if ``refresh`` is true the caller must refresh the stale entry
+                 and report back with ``end_refresh()``
+        """
+        fetched_at, _, value = self.store.get(key) or (0, None, _MISSING)
+        age = time.time() - fetched_at
+        with self._lock:
+            if value is not _MISSING and age < ttl:
+                self.stats['hits'] += 1
+                return True, value, False
+            if value is not _MISSING and age < max_stale:
+                self.stats['stale'] += 1
+                refresh = key not in self._refreshing
+                self._refreshing.add(key)
+                return True, value, refresh
+            self.stats['misses'] += 1
+            return False, None, False
+
+    def end_refresh(self, key, failed: bool = False):
+        with self._lock:
+            if failed:
+                self.stats['refresh_errors'] += 1
+            self._refreshing.discard(key)
+
+    def set(self, key, value):
+        self.store.set(key, value)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+
+# path -> sqlite3 connection of the current thread - see SQLiteCacheStore
+_sqlite_connections = threading.local()
+
+
+class SQLiteCacheStore:
+    """
+    The entries of a cache in an SQLite database in WAL mode, shared by all the door IVR processes without a daemon -
+    e.g. the ``door_ivr.py`` processes Asterisk starts per call. Every thread of every process has a connection of its
+    own and writers wait up to ``busy_timeout`` seconds for each other.
+
+    Each cache has a ``namespace`` of its own in the database and its least recently used entries are evicted once
+    there are more than ``max_entries``. Database errors are reported on stderr and handled as cache misses.
+    """
+
+    # seconds between updating the last use of an entry when it is read - an approximate LRU, so reads rarely write
+    USED_AT_RESOLUTION = 60
+
+    blocking = True
+
+    def __init__(self, path: Path, namespace: str, max_entries: int, busy_timeout: float):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+
+    def _connect(self) -> 'sqlite3.Connection':
+        connection = getattr(_sqlite_connections, str(self.path), None)
+        if connection is None:
+            import sqlite3
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # the database holds auth tokens - readable by the owner only (the -wal and -shm files inherit the mode)
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entries (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                'value TEXT NOT NULL, stored_at REAL NOT NULL, expires_at REAL, used_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, key)) WITHOUT ROWID')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS cache_entries_used_at ON cache_entries (namespace, used_at)')
+            setattr(_sqlite_connections, str(self.path), connection)
+        return connection
+
+    def _report(self, action: str, exc: Exception):
+        sys.stderr.write('%s the %s cache in %s failed - %r\n' % (action, self.namespace, self.path, exc))
+
+    def get(self, key) -> typing.Optional[typing.Tuple[float, typing.Optional[float], typing.Any]]:
+        """
+        :return: the entry as ``(stored_at, expires_at, value)`` or None if it is missing or expired
+        """
+        import sqlite3
+
+        now = time.time()
+        try:
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT value, stored_at, expires_at, used_at FROM cache_entries WHERE namespace = ? AND key = ?',
+                (self.namespace, str(key))).fetchone()
+            if row is None or (row[2] is not None and row[2] <= now):
+                return None  # expired entries are removed by set()
+            if now - row[3] > self.USED_AT_RESOLUTION:
+                connection.execute('UPDATE cache_entries SET used_at = ? WHERE namespace = ? AND key = ?',
+                                   (now, self.namespace, str(key)))
+            return row[1], row[2], json.loads(row[0])
+        except (sqlite3.Error, OSError, ValueError) as exc:
+            self._report('Reading', exc)
+            return None
+
+    def set(self, key, value, expires_at: typing.Optional[float] = None):
+        """
+        Store an entry and evict the expired and the least recently used entries over ``max_entries``.
+        """
+        import sqlite3
+
+        now = time.time()
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?)',
+                                   (self.namespace, str(key), json.dumps(value), now, expires_at, now))
+                connection.execute(
+                    'DELETE FROM cache_entries WHERE namespace = ? AND (expires_at <= ? OR key IN ('
+                    'SELECT key FROM cache_entries WHERE namespace = ? ORDER BY used_at DESC LIMIT -1 OFFSET ?))',
+                    (self.namespace, now, self.namespace, self.max_entries))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        except (sqlite3.Error, OSError, TypeError, ValueError) as exc:
+            self._report('Writing', exc)
+
+    def delete(self, key):
+        import sqlite3
+
+        try:
+            self._connect().execute('DELETE FROM cache_entries WHERE namespace = ? AND key = ?',
+                                    (self.namespace, str(key)))
+        except (sqlite3.Error, OSError) as exc:
+            self._report('Deleting from', exc)
+
+
+class OfflineAuthStore:
+    """
+    The last known auth state of every phone number - the auth token, the locale, the doors and a salted PBKDF2
+    hash of the pin - kept in a JSON file shared by all the door IVR processes. Used when the backend misses the
+    ``deadline`` (see ``door_ivr.BackendLookups`` and ``door_ivr.AbstractDoorManager.is_correct_pin``), so members
+    can still open the doors while fauna is slow or down.
+
+    Every value is stored with the time the backend last confirmed it and is used for ``max_age`` seconds after.
+    The backend answers always win - stored values are updated or removed as soon as they arrive.
+    """
+
+    def __init__(self, path: Path, max_age: float, deadline: float, pin_hash_iterations: int):
+        self.path = path
+        self.max_age = max_age
+        self.deadline = deadline
+        self.pin_hash_iterations = pin_hash_iterations
+
+    def _read(self) -> typing.Dict[str, dict]:
+        try:
+            with open(self.path) as store_file:
+                return json.load(store_file)
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def _update(self):
+        """
+        Yield the entries by phone number for changing them in place, then save them.
+
+        Writers hold an exclusive lock on ``<path>.lock`` and replace the file, so readers never need a lock.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._read()
+            yield entries
+            now = time.time()
+            for phone_number, entry in list(entries.items()):
+                for field, value in list(entry.items()):
+                    if now - value['checked_at'] > self.max_age:
+                        del entry[field]
+                if not entry:
+                    del entries[phone_number]
+
+            temp_file = f'{self.path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            try:
+                # the file holds the pin hashes and the tokens - readable by the owner only
+                with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as store_file:
+                    json.dump(entries, store_file)
+                os.replace(temp_file, self.path)
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(temp_file)
+
+    def get(self, phone_number: str) -> typing.Dict[str, typing.Any]:
+        """
+        Return the stored ``auth_token``, ``locale`` and ``doors`` of a phone number which are younger than
+        ``max_age`` (and for the token - not expired).
+        """
+        now = time.time()
+        values = {}
+        for field, value in self._read().get(phone_number, {}).items():
+            if field == 'pin' or now - value['checked_at'] > self.max_age:
+                continue
+            if field == 'auth_token' and value['expires_at'] <= now:
+                continue
+            values[field] = value['value']
+        return values
+
+    def set(self, phone_number: str, field: str, value, **extra):
+        with self._update() as entries:
+            entries.setdefault(phone_number, {})[field] = {'checked_at': time.time(), 'value': value, **extra}
+
+    def set_auth_token(self, phone_number: str, token: str, ttl: float):
+        if ttl > 0:
+            self.set(phone_number, 'auth_token', token, expires_at=time.time() + ttl)
+
+    @staticmethod
+    def hash_pin(pin: str, salt: bytes, iterations: int) -> str:
+        import hashlib
+
+        return hashlib.pbkdf2_hmac('sha256', pin.encode('utf-8'), salt, iterations).hex()
+
+    def set_pin(self, phone_number: str, pin: typing.Optional[str]):
+        """
+        Store the hash of a pin the backend accepted, or forget the stored one if ``pin`` is None.
+        """
+        if pin is None:
+            with self._update() as entries:
+                entries.get(phone_number, {}).pop('pin', None)
+            return
+        salt = os.urandom(16)
+        # slow on purpose - computed before taking the lock
+        pin_hash = self.hash_pin(pin, salt, self.pin_hash_iterations)
+        with self._update() as entries:
+            entries.setdefault(phone_number, {})['pin'] = {
+                'checked_at': time.time(), 'salt': salt.hex(), 'hash': pin_hash, 'iterations': self.pin_hash_iterations,
+            }
+
+    def check_pin(self, phone_number: str, pin: str) -> bool:
+        """
+        Return whether ``pin`` is the last pin of the phone number the backend accepted within ``max_age``.
+        """
+        import hmac
+
+        stored_pin = self._read().get(phone_number, {}).get('pin')
+        if stored_pin is None or time.time() - stored_pin['checked_at'] > self.max_age:
+            return False
+        pin_hash = self.hash_pin(pin, bytes.fromhex(stored_pin['salt']), stored_pin['iterations'])
+        return hmac.compare_digest(pin_hash, stored_pin['hash'])
+
+    def delete(self, phone_number: str):
+        with self._update() as entries:
+            entries.pop(phone_number, None)
+
+
+class ChannelDebounce:
+    """
+    Let a single request per ``key`` (e.g. a channel and the feature key pressed on it) through at a time, and none
+    for ``window`` seconds after one succeeded, so pressing a key repeatedly doesn't stack up backend requests.
+
+    Shared by all the door IVR processes through a lock file per key in ``directory``, which holds the time of the
+    last success. The lock is released with ``release()`` or at the end of the ``with`` block.
+    """
+
+    # lock files unused for longer are removed - the calls they belong to have ended
+    MAX_AGE = 24 * 3600
+
+    def __init__(self, directory: Path, key: str, window: float):
+        self.directory = directory
+        self.path = directory.joinpath(re.sub(r'[^\w.-]', '_', key))
+        self.window = window
+        self.claimed = False
+        self._lock_file: typing.Optional[typing.TextIO] = None
+
+    def claim(self) -> bool:
+        """
+        :return: whether the request may go on - False while another one is in progress or within the window
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._lock_file.seek(0)
+        try:
+            succeeded_at = float(self._lock_file.read() or 0)
+        except ValueError:
+            succeeded_at = 0
+        self.claimed = time.time() - succeeded_at >= self.window
+        if self.claimed:
+            self.evict()
+        return self.claimed
+
+    def succeeded(self):
+        self._lock_file.truncate(0)
+        self._lock_file.write(str(time.time()))
+        self._lock_file.flush()
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def evict(self):
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            with contextlib.suppress(OSError):
+                if now - entry.stat().st_mtime > self.MAX_AGE:
+                    os.unlink(entry.path)
+
+    def __enter__(self) -> 'ChannelDebounce':
+        self.claim()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+# phone number -> auth token, or None for numbers unknown to the backend
+auth_token_cache = TTLCache()
+
+# auth token -> portier doors list
+doors_cache = StaleWhileRevalidateCache()
+
+# auth token -> locale of the user
+user_locale_cache = TTLCache()
+
+# auth API url -> True while its backend answers 404 to session_bootstrap
+session_bootstrap_missing = TTLCache()
+
+# the process-wide caches by their namespace in a shared cache store - see configure_caches
+CACHES: typing.Dict[str, typing.Union[TTLCache, StaleWhileRevalidateCache]] = {
+    'auth_token': auth_token_cache,
+    'doors': doors_cache,
+    'user_locale': user_locale_cache,
+    'session_bootstrap_missing': session_bootstrap_missing,
+}
+
+
+def configure_caches(config: configparser.ConfigParser):
+    """
+    Keep the process-wide caches in the ``[cache] store`` - ``memory`` (the default, per process) or ``sqlite``,
+    a database in ``[cache] path`` (relative to the working directory, like the assets) shared by all the processes.
+    The database is opened on first use.
+    """
+    store = config.get('cache', 'store', fallback='memory')
+    if store == 'memory':
+        return
+    if store != 'sqlite':
+        raise ValueError(f"Unknown [cache] store {store!r} - use memory or sqlite")
+    path = Path.cwd().joinpath(config.get('cache', 'path', fallback='initlab-telephony-cache.sqlite3'))
+    for namespace, cache in CACHES.items():
+        cache.store = SQLiteCacheStore(
+            path, namespace,
+            max_entries=config.getint('cache', 'max_entries', fallback=10000),
+            busy_timeout=config.getfloat('cache', 'busy_timeout', fallback=1),
+        )
+
+
+_offline_auth_store: typing.Optional[OfflineAuthStore] = None
+
+
+def get_offline_auth_store(config: configparser.ConfigParser) -> typing.Optional[OfflineAuthStore]:
+    """
+    Return the offline auth store in ``[offline_auth] path`` (relative to the working directory, like the assets),
+    or None if ``path`` is empty - the default.
+    """
+    global _offline_auth_store
+    path = config.get('offline_auth', 'path', fallback='')
+    if not path:
+        return None
+    with _shared_resources_lock:
+        if _offline_auth_store is None:
+            _offline_auth_store = OfflineAuthStore(
+                Path.cwd().joinpath(path),
+                max_age=config.getfloat('offline_auth', 'max_age', fallback=7 * 24 * 3600),
+                deadline=config.getfloat('offline_auth', 'deadline', fallback=2),
+                pin_hash_iterations=config.getint('offline_auth', 'pin_hash_iterations', fallback=100000),
+            )
+        return _offline_auth_store
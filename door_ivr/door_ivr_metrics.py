@@ -0,0 +1,162 @@
+"""
+Call stage timings of the door IVR and their Prometheus metrics
+"""
+import configparser
+import contextlib
+import functools
+import json
+import threading
+import time
+import typing
+
+from door_ivr_caches import doors_cache
+
+if typing.TYPE_CHECKING:
+    # imported on first use only (see start_metrics_server) - every call started by Asterisk's AGI() is a new process
+    import http.server
+
+
+# upper bounds of the stage duration histogram buckets in seconds
+STAGE_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class StageHistograms:
+    """
+    Thread-safe duration histograms of the call stages by stage, handler and outcome.
+    """
+
+    def __init__(self, buckets: typing.Sequence[float] = STAGE_DURATION_BUCKETS):
+        self.buckets = buckets
+        # (stage, handler, outcome) -> [bucket counts..., sum, count]
+        self._histograms: typing.Dict[typing.Tuple[str, str, str], typing.List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, handler: str, outcome: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.setdefault((stage, handler, outcome), [0] * (len(self.buckets) + 2))
+            for index, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def render_prometheus(self) -> str:
+        """
+        Return the histograms (and the doors cache counters) in the Prometheus text exposition format.
+        """
+        lines = [
+            '# HELP door_ivr_stage_duration_seconds Duration of the door IVR call stages',
+            '# TYPE door_ivr_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            for (stage, handler, outcome), histogram in sorted(self._histograms.items()):
+                labels = f'stage="{stage}",handler="{handler}",outcome="{outcome}"'
+                for upper_bound, count in zip(self.buckets, histogram):
+                    lines.append(f'door_ivr_stage_duration_seconds_bucket{{{labels},le="{upper_bound}"}} {count}')
+                lines.append(f'door_ivr_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+                lines.append(f'door_ivr_stage_duration_seconds_sum{{{labels}}} {histogram[-2]}')
+                lines.append(f'door_ivr_stage_duration_seconds_count{{{labels}}} {histogram[-1]}')
+        lines += [
+            '# HELP door_ivr_doors_cache_total Doors cache lookups by result',
+            '# TYPE door_ivr_doors_cache_total counter',
+        ]
+        for result, count in sorted(doors_cache.stats.items()):
+            lines.append(f'door_ivr_doors_cache_total{{result="{result}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# stage durations of all the calls handled by this process
+stage_histograms = StageHistograms()
+
+
+class CallTimings:
+    """
+    Durations of the stages (backend requests, AGI commands, ...) of a single call.
+    """
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.started_at = time.time()
+        self.stages: typing.List[typing.Tuple[str, float, str]] = []  # (stage, seconds, outcome)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        """
+        Record the duration of the ``with`` block as ``stage`` - the outcome is ``error`` if it raises.
+        """
+        started_at = time.monotonic()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.record(stage, time.monotonic() - started_at, outcome)
+
+    def record(self, stage: str, seconds: float, outcome: str = 'ok'):
+        self.stages.append((stage, seconds, outcome))  # list.append is thread-safe
+
+    def export(self, config: configparser.ConfigParser):
+        """
+        Add the timings to ``stage_histograms`` and append them as a JSON line to ``[metrics] json_log``, if set.
+        """
+        for stage, seconds, outcome in self.stages:
+            stage_histograms.observe(stage, self.handler, outcome, seconds)
+
+        json_log = config.get('metrics', 'json_log', fallback='')
+        if json_log:
+            with open(json_log, 'a') as json_log_file:
+                json_log_file.write(json.dumps({
+                    'started_at': self.started_at,
+                    'handler': self.handler,
+                    'stages': [
+                        {'stage': stage, 'seconds': round(seconds, 6), 'outcome': outcome}
+                        for stage, seconds, outcome in self.stages
+                    ],
+                }) + '\n')
+
+
+def timed_stage(stage: str):
+    """
+    Decorate a coroutine of the call flow to record its duration in ``self.timings`` as ``stage``.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with self.timings.time(stage):
+                return await method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_metrics_server(config: configparser.ConfigParser) -> typing.Optional['http.server.ThreadingHTTPServer']:
+    """
+    Serve ``stage_histograms`` on ``http://[metrics] prometheus_host:prometheus_port/metrics`` in a daemon thread,
+    if the port is configured.
+    """
+    port = config.get('metrics', 'prometheus_port', fallback='')
+    if not port:
+        return None
+
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = stage_histograms.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scraping every few seconds would flood stderr
+
+    server = http.server.ThreadingHTTPServer(
+        (config.get('metrics', 'prometheus_host', fallback='127.0.0.1'), int(port)), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
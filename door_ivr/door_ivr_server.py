@@ -0,0 +1,75 @@
+"""
+Threaded FastAGI server of ``door_ivr.py --serve``
+"""
+import configparser
+import socketserver
+import sys
+import typing
+
+from asterisk.agi import AGIHangup
+
+FASTAGI_DEFAULT_PORT = 4573
+
+
+def read_agi_env(stdin) -> typing.Dict[str, str]:
+    """
+    Read the AGI environment block (``key: value`` lines terminated by an empty line)
+    the same way pyst2's AGI does.
+    """
+    env = {}
+    while True:
+        line = stdin.readline().strip()
+        if line == '':
+            break
+        key, _, data = line.partition(':')
+        if key.strip():
+            env[key.strip()] = data.strip()
+    return env
+
+
+class FastAGIRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle a single FastAGI channel, e.g. ``AGI(agi://127.0.0.1:4573/in-call,1)``.
+
+    The request path selects the door manager class (see ``FastAGIServer``) and the first AGI argument is used as
+    ``--phone``.
+    """
+
+    def handle(self):
+        stdin = self.connection.makefile('r', encoding='utf-8', newline='\n')
+        stdout = self.connection.makefile('w', encoding='utf-8', newline='\n')
+        try:
+            agi_env = read_agi_env(stdin)
+            handler = agi_env.get('agi_network_script', '').strip('/').split('?')[0]
+            door_manager_class = self.server.door_manager_classes.get(handler)
+            if door_manager_class is None:
+                sys.stderr.write('Unknown FastAGI handler %r from %s\n' % (handler, self.client_address))
+                return
+            door_manager = door_manager_class(config=self.server.config,
+                                              phone_number=agi_env.get('agi_arg_1') or None,
+                                              agi_env=agi_env, stdin=stdin, stdout=stdout)
+            door_manager.run_phone_call()
+        except AGIHangup:
+            pass  # the caller hung up - nothing more to do
+        except Exception as exc:
+            sys.stderr.write('Error handling FastAGI request from %s - %r\n' % (self.client_address, exc))
+        finally:
+            stdout.close()
+            stdin.close()
+
+
+class FastAGIServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded FastAGI server running each channel with a ``door_ivr.BlockingDoorManager`` of
+    ``door_manager_classes`` (handler -> class).
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # listen backlog - socketserver's default of 5 delays the answer of bursts of calls by a SYN retransmit (1s)
+    request_queue_size = 100
+
+    def __init__(self, server_address, config: configparser.ConfigParser, door_manager_classes: typing.Dict[str, type]):
+        self.config = config
+        self.door_manager_classes = door_manager_classes
+        super().__init__(server_address, FastAGIRequestHandler)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+Tests of the prompt assets of door_ivr.py - the joined door menu prompts, --build-assets and --verify-assets - with
+the small audio files in fixtures/.
+
+Written without any dependencies besides the ones of door_ivr.py.
+
+Usage:
+    ./assets_test.py
+    ./assets_test.py -v PromptCompositorTest
+"""
+
+import configparser
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import wave
+
+from pathlib import Path
+
+TESTS_DIR = Path(__file__).resolve().parent
+DOOR_IVR_DIR = TESTS_DIR.parent
+FIXTURES_DIR = TESTS_DIR / 'fixtures'
+
+sys.path.insert(0, str(DOOR_IVR_DIR))
+
+import door_ivr_assets  # noqa: E402
+
+# the modification time of the fixtures, so the keys of the joined files don't depend on the checkout
+FIXTURE_MTIME_NS = 1600000000 * 10 ** 9
+
+
+class FixtureAssetsTestCase(unittest.TestCase):
+    """
+    Runs every test in a temporary working directory with a copy of fixtures/initlab-telephony-assets.
+    """
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        shutil.copytree(FIXTURES_DIR / 'initlab-telephony-assets', Path(temp_dir.name, 'initlab-telephony-assets'))
+        for directory, _, filenames in os.walk(temp_dir.name):
+            for filename in filenames:
+                os.utime(os.path.join(directory, filename), ns=(FIXTURE_MTIME_NS, FIXTURE_MTIME_NS))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(temp_dir.name)
+        # relative, so the keys of the joined files don't depend on the temporary directory either
+        self.sounds_path = Path('initlab-telephony-assets', 'files')
+
+
+class PromptCompositorTest(FixtureAssetsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = Path('initlab-telephony-prompt-cache')
+        self.compositor = door_ivr_assets.PromptCompositor(self.cache_dir, max_age=3600)
+        self.prompts = door_ivr_assets.get_door_menu_prompts(self.sounds_path, 'bg', ['1', '2'])
+
+    def read_frames(self, path: str) -> bytes:
+        with wave.open(path, 'rb') as wave_file:
+            self.assertEqual((wave_file.getnchannels(), wave_file.getsampwidth(), wave_file.getframerate()),
+                             (1, 2, 8000))
+            return wave_file.readframes(wave_file.getnframes())
+
+    def test_door_menu_prompts(self):
+        # without waiting_on_input, which is played on its own after the menu
+        self.assertEqual(self.prompts, [self.sounds_path / 'bg/door_prompt_1', self.sounds_path / 'bg/door_prompt_2'])
+
+    def test_joins_every_common_format(self):
+        joined = self.compositor.compose('door_menu-bg-1-2', self.prompts)
+
+        self.assertEqual(joined, self.cache_dir / 'door_menu-bg-1-2--3f295080')
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['door_menu-bg-1-2--3f295080.sln', 'door_menu-bg-1-2--3f295080.wav'])
+        self.assertEqual(Path(f'{joined}.sln').read_bytes(),
+                         b''.join(Path(f'{prompt}.sln').read_bytes() for prompt in self.prompts))
+        self.assertEqual(self.read_frames(f'{joined}.wav'),
+                         b''.join(self.read_frames(f'{prompt}.wav') for prompt in self.prompts))
+
+    def test_reuses_the_joined_file(self):
+        joined = self.compositor.compose('door_menu-bg-1-2', self.prompts)
+        os.utime(f'{joined}.sln', ns=(FIXTURE_MTIME_NS, FIXTURE_MTIME_NS))
+
+        self.assertEqual(self.compositor.compose('door_menu-bg-1-2', self.prompts), joined)
+        self.assertGreater(os.stat(f'{joined}.sln').st_mtime_ns, FIXTURE_MTIME_NS)  # marked as used
+
+    def test_rebuilds_when_a_prompt_changes(self):
+        joined = self.compositor.compose('door_menu-bg-1-2', self.prompts)
+        changed_at = FIXTURE_MTIME_NS + 10 ** 9
+        Path(f'{self.prompts[1]}.sln').write_bytes(Path(f'{self.prompts[0]}.sln').read_bytes())
+        os.utime(f'{self.prompts[1]}.sln', ns=(changed_at, changed_at))
+
+        rebuilt = self.compositor.compose('door_menu-bg-1-2', self.prompts)
+
+        self.assertNotEqual(rebuilt, joined)
+        # the .wav prompts didn't change, but the key covers every common format
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [f'{rebuilt.name}.sln', f'{rebuilt.name}.wav'])
+        self.assertEqual(Path(f'{rebuilt}.sln').read_bytes(), Path(f'{self.prompts[0]}.sln').read_bytes() * 2)
+
+    def test_no_common_format(self):
+        os.unlink(f'{self.prompts[0]}.sln')
+        os.unlink(f'{self.prompts[1]}.wav')
+
+        self.assertIsNone(self.compositor.compose('door_menu-bg-1-2', self.prompts))
+        self.assertFalse(self.cache_dir.exists())
+
+
+class BuildAssetsTest(FixtureAssetsTestCase):
+    """
+    ``door_ivr.py --build-assets`` and ``--verify-assets`` with fixtures/convert.py as the ``convert_command``.
+
+    The originals are bg/door_prompt_1.wav, bg/door_prompt_2.sln and .wav and waiting_on_input.sln - sln ranks
+    below the wav converted from it. The other prompts are copies of waiting_on_input.sln.
+    """
+
+    def setUp(self):
+        super().setUp()
+        config = configparser.ConfigParser()
+        config.read(DOOR_IVR_DIR / 'door_ivr.test.conf')
+        config['assets'].update({
+            'formats': 'sln wav',
+            'convert_command': f"{shlex.quote(sys.executable)} {shlex.quote(str(FIXTURES_DIR / 'convert.py'))} "
+                               f"{{source}} {{target}}",
+            'locales': 'bg',
+            'door_numbers': '1-2',
+        })
+        with open('door_ivr.assets.test.conf', 'w') as config_file:
+            config.write(config_file)
+
+        os.unlink(self.sounds_path / 'bg/door_prompt_1.sln')
+        for name in door_ivr_assets.list_asset_prompts(config, self.sounds_path):
+            if not door_ivr_assets.PromptCompositor.get_formats(self.sounds_path / name):
+                shutil.copy2(self.sounds_path / 'waiting_on_input.sln', self.sounds_path / f'{name}.sln')
+        self.originals = self.snapshot()
+
+    def run_door_ivr(self, option: str) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, str(DOOR_IVR_DIR / 'door_ivr.py'), '--config=door_ivr.assets.test.conf',
+                               option], capture_output=True, text=True, timeout=60)
+
+    def snapshot(self) -> dict:
+        """
+        Return the contents and modification times of the files of the prompts by their path.
+        """
+        return {
+            os.path.join(directory, filename): (Path(directory, filename).read_bytes(),
+                                                os.stat(os.path.join(directory, filename)).st_mtime_ns)
+            for directory, _, filenames in os.walk(self.sounds_path)
+            for filename in filenames
+            if filename != door_ivr_assets.AssetManifest.FILENAME
+        }
+
+    def read_frames(self, prompt: str) -> bytes:
+        with wave.open(str(self.sounds_path / f'{prompt}.wav'), 'rb') as wave_file:
+            return wave_file.readframes(wave_file.getnframes())
+
+    def build(self):
+        result = self.run_door_ivr('--build-assets')
+        self.assertEqual((result.returncode, result.stderr), (0, ''))
+
+    def test_build_and_verify(self):
+        self.build()
+
+        with open(self.sounds_path / door_ivr_assets.AssetManifest.FILENAME) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['sources']['bg/door_prompt_1'], 'wav')
+        self.assertEqual(manifest['sources']['bg/door_prompt_2'], 'wav')
+        self.assertEqual(manifest['sources']['waiting_on_input'], 'sln')
+        self.assertEqual(set(manifest['sources']), set(manifest['prompts']))
+        self.assertTrue(all(set(formats) == {'sln', 'wav'} for formats in manifest['prompts'].values()))
+
+        self.assertEqual((self.sounds_path / 'bg/door_prompt_1.sln').read_bytes(), self.read_frames('bg/door_prompt_1'))
+        self.assertEqual((self.sounds_path / 'waiting_on_input.sln').read_bytes(), self.read_frames('waiting_on_input'))
+        current = self.snapshot()
+        self.assertEqual({path: current[path] for path in self.originals}, self.originals)
+
+        result = self.run_door_ivr('--verify-assets')
+        self.assertEqual((result.returncode, result.stderr), (0, ''))
+
+    def test_building_again_keeps_the_originals(self):
+        self.build()
+        built = self.snapshot()
+
+        self.build()
+
+        # nothing converted again - in particular not waiting_on_input.sln from the better ranked .wav
+        self.assertEqual(self.snapshot(), built)
+
+    def test_building_again_converts_a_changed_original(self):
+        self.build()
+        new_frames = (self.sounds_path / 'bg/door_prompt_2.sln').read_bytes()
+        (self.sounds_path / 'waiting_on_input.sln').write_bytes(new_frames)  # newer than the converted .wav
+
+        self.build()
+
+        self.assertEqual(self.read_frames('waiting_on_input'), new_frames)
+        result = self.run_door_ivr('--verify-assets')
+        self.assertEqual((result.returncode, result.stderr), (0, ''))
+
+    def test_verify_reports_the_problems(self):
+        prompts_path = Path.cwd() / self.sounds_path
+        result = self.run_door_ivr('--verify-assets')
+        self.assertEqual((result.returncode, result.stderr), (
+            1, f'There is no asset manifest in {prompts_path} - build the assets with --build-assets\n'
+        ))
+
+        self.build()
+        os.unlink(self.sounds_path / 'bg/door_prompt_1.sln')
+        os.utime(self.sounds_path / 'waiting_on_input.wav')
+
+        result = self.run_door_ivr('--verify-assets')
+        self.assertEqual(result.returncode, 1)
+        outdated = 'The asset manifest is outdated for {} - build the assets with --build-assets'
+        self.assertEqual(result.stderr.splitlines(), [
+            f'{prompts_path}/bg/door_prompt_1 is missing in sln',
+            outdated.format(prompts_path / 'bg/door_prompt_1'),
+            outdated.format(prompts_path / 'waiting_on_input'),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
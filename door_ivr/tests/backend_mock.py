@@ -4,92 +4,399 @@
 Mock http server of {fauna|portier}.initlab.org's door API.
 
 Written without any dependencies as the intention is to be standalone.
+
+By default it answers instantly with the data the AGI test scripts expect. For benchmarks it can behave like a slow or
+overloaded backend, per endpoint (``phone_number_token``, ``session_bootstrap``, ``verify_pin``, ``current_user``,
+``doors``, ``door_action`` or ``*`` for all of them):
+
+    ./backend_mock.py --latency='*=normal:40:15' --latency=door_action=uniform:200:800
+    ./backend_mock.py --fail=doors=0.1:503 --fail=door_action=0.05:reset --fail=verify_pin=0.01:timeout
+    ./backend_mock.py --max-concurrent=4 --doors=9 --users=100
+    ./backend_mock.py --no-session-bootstrap  # 404 like a backend without the endpoint
+    ./backend_mock.py --no-door-status-stream --status-delay=0.5  # door status polling only, slow lock confirmations
+
+The lockable doors start locked (unless ``--unlocked``). Their statuses follow the door actions and are served on
+``GET doors/statuses`` and as server-sent events on ``GET doors/statuses/stream``.
+
+The number of requests (and injected failures) per endpoint and the number of performed and deduplicated (by their
+``Idempotency-Key``) door actions are served on ``GET /stats`` and printed on exit.
 """
 
+import argparse
+import collections
 import http
 import json
 import http.server
+import random
 import re
-import socketserver
+import signal
+import socket
+import struct
+import threading
+import time
+import urllib.parse
 
 PORT = 3002
 
+ENDPOINTS = ('phone_number_token', 'session_bootstrap', 'verify_pin', 'current_user', 'doors', 'door_action',
+             'door_statuses', 'door_status_stream')
 
-class FaunaHandler(http.server.BaseHTTPRequestHandler):
+DOORS = [
+    {'id': 'example_door', 'name': 'Врата', 'supported_actions': ['open'], 'number': 1},
+    {'id': 'example_door_2', 'name': 'Врата 2', 'supported_actions': ['open', 'unlock', 'lock'], 'number': 2},
+    {'id': 'example_door_3', 'name': 'Врата 3', 'supported_actions': ['lock', 'unlock', 'open'], 'number': 3},
+]
+
+USER = {
+    "id": 123,
+    "name": "Some User",
+    "url": "",
+    "twitter": "",
+    "username": "someuser",
+    "github": "",
+    "jabber": "",
+    "picture": ".....",
+    "locale": "bg",
+    "announce_my_presence": False,
+    "roles": [
+        "member",
+        "trusted_member",
+    ]
+}
+
+LATENCY_DISTRIBUTIONS = {
+    # name: (number of parameters, milliseconds sampler)
+    'fixed': (1, lambda milliseconds: milliseconds),
+    'uniform': (2, random.uniform),
+    'normal': (2, lambda mean, deviation: max(0.0, random.gauss(mean, deviation))),
+    'exp': (1, lambda mean: random.expovariate(1 / mean) if mean else 0.0),
+}
+
+
+def make_doors(count):
+    return DOORS[:count] + [
+        {'id': f'example_door_{number}', 'name': f'Врата {number}', 'supported_actions': ['open', 'unlock', 'lock'],
+         'number': number}
+        for number in range(len(DOORS) + 1, count + 1)
+    ]
+
+
+def user_token(user_index):
+    return 'abc' if user_index == 0 else f'abc{user_index}'
+
+
+def make_user(user_index):
+    if user_index == 0:
+        return USER
+    return {**USER, 'id': USER['id'] + user_index, 'name': f"Some User {user_index}",
+            'username': f"someuser{user_index}"}
+
+
+def endpoint_option(parse):
+    """
+    argparse type of ``ENDPOINT=SPEC`` options.
+    """
+    def parse_option(value):
+        endpoint, sep, spec = value.partition('=')
+        if not sep or endpoint not in ENDPOINTS + ('*',):
+            raise argparse.ArgumentTypeError(f"expected ENDPOINT=SPEC with ENDPOINT one of {', '.join(ENDPOINTS)}, *")
+        return endpoint, parse(spec)
+    return parse_option
 
-    def setup(self):
-        self.server.allow_reuse_address = True
-        super().setup()
+
+def parse_latency(spec):
+    """
+    ``fixed:MS``, ``uniform:MIN_MS:MAX_MS``, ``normal:MEAN_MS:STDDEV_MS`` or ``exp:MEAN_MS``, a plain number is
+    ``fixed``.
+    """
+    name, *params = spec.split(':')
+    if not params:
+        name, params = 'fixed', [name]
+    if name not in LATENCY_DISTRIBUTIONS or len(params) != LATENCY_DISTRIBUTIONS[name][0]:
+        raise argparse.ArgumentTypeError(f"invalid latency {spec!r}")
+    try:
+        params = [float(param) for param in params]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid latency {spec!r}")
+    sampler = LATENCY_DISTRIBUTIONS[name][1]
+    return lambda: sampler(*params) / 1000
+
+
+def parse_failure(spec):
+    """
+    ``RATE:MODE``, where MODE is a http status code, ``timeout`` (no response) or ``reset`` (TCP RST).
+    """
+    rate, sep, mode = spec.partition(':')
+    try:
+        rate = float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid failure rate {spec!r}")
+    if not sep or not (mode in ('timeout', 'reset') or mode.isdigit()):
+        raise argparse.ArgumentTypeError(f"invalid failure mode {spec!r}")
+    return rate, mode
+
+
+class FaunaServer(http.server.ThreadingHTTPServer):
+
+    def __init__(self, server_address, options):
+        super().__init__(server_address, FaunaHandler)
+        self.doors = make_doors(options.doors)
+        self.users = options.users
+        self.latencies = dict(options.latency)
+        self.failures = dict(options.fail)
+        self.hang = options.hang
+        self.session_bootstrap = options.session_bootstrap
+        self.concurrency = threading.BoundedSemaphore(options.max_concurrent) if options.max_concurrent else None
+        self.stats_lock = threading.Lock()
+        self.request_counts = collections.Counter()
+        self.failure_counts = collections.Counter()
+        self.door_action_counts = collections.Counter()
+        self.door_action_keys = set()  # Idempotency-Key headers of the performed door actions
+        self.door_status_stream = options.door_status_stream
+        self.status_delay = options.status_delay
+        self.heartbeat = options.heartbeat
+        self.door_statuses = {
+            door['id']: 'unlocked' if door['id'] in options.unlocked else 'locked'
+            for door in self.doors if 'lock' in door['supported_actions']
+        }
+        self.door_status_events = []  # every status change, streamed from the position of each subscriber
+        self.door_status_changed = threading.Condition()
+
+    def for_endpoint(self, settings, endpoint):
+        return settings.get(endpoint, settings.get('*'))
+
+    def count(self, counter, endpoint):
+        with self.stats_lock:
+            counter[endpoint] += 1
+
+    def set_door_status(self, door_id, status):
+        with self.door_status_changed:
+            self.door_statuses[door_id] = status
+            self.door_status_events.append({'id': door_id, 'status': status})
+            self.door_status_changed.notify_all()
+
+    def stats(self):
+        with self.stats_lock:
+            return {'requests': dict(self.request_counts), 'failures': dict(self.failure_counts),
+                    'door_actions': dict(self.door_action_counts)}
+
+
+class FaunaHandler(http.server.BaseHTTPRequestHandler):
 
     def do_GET(self):
         if self.path == '/api/doors':
-            self.send_response(http.HTTPStatus.OK)
-            self.end_headers()
-            self.wfile.write(
-                json.dumps(
-                    [
-                        {'id': 'example_door', 'name': 'Врата', 'supported_actions': ['open'], 'number': 1},
-                        {'id': 'example_door_2', 'name': 'Врата 2', 'supported_actions': ['open', 'unlock', 'lock'], 'number': 2},
-                        {'id': 'example_door_3', 'name': 'Врата 3', 'supported_actions': ['lock', 'unlock', 'open'], 'number': 3},
-                    ],
-                    indent=4
-                ).encode('utf-8')
-            )
+            self.handle_endpoint('doors', self.get_doors)
         elif self.path == '/api/current_user':
-            self.send_response(http.HTTPStatus.OK)
-            self.end_headers()
-            self.wfile.write(
-                json.dumps(
-                    {
-                        "id": 123,
-                        "name": "Some User",
-                        "url": "",
-                        "twitter": "",
-                        "username": "someuser",
-                        "github": "",
-                        "jabber": "",
-                        "picture": ".....",
-                        "locale": "bg",
-                        "announce_my_presence": False,
-                        "roles": [
-                            "member",
-                            "trusted_member",
-                        ]
-                    },
-                    indent=4
-                ).encode('utf-8')
-            )
+            self.handle_endpoint('current_user', self.get_current_user)
+        elif self.path == '/api/doors/statuses':
+            self.handle_endpoint('door_statuses', self.get_door_statuses)
+        elif self.path == '/api/doors/statuses/stream':
+            self.handle_endpoint('door_status_stream', self.get_door_status_stream)
+        elif self.path == '/stats':
+            self.send_json(http.HTTPStatus.OK, self.server.stats())
         else:
             raise NotImplementedError(f"GET {self.path!r} is not implemented")
 
     def do_POST(self):
         post_data = self.rfile.read(int(self.headers['content-length']))
         print('POST data:', post_data)
-        door_action_re = re.compile(r"/api/doors/[^/]+/(open|lock|unlock)")
+        door_action_re = re.compile(r"/api/doors/([^/]+)/(open|lock|unlock)")
         if self.path == '/api/phone_access/phone_number_token':
-            if post_data.endswith(b'880000000'):  # hack to have a not-found result
-                self.send_response(http.HTTPStatus.NOT_FOUND)
-                self.end_headers()
-                self.wfile.write(b'{}')  # the response body is not inline with the backend
-            else:
-                self.send_response(http.HTTPStatus.OK)
-                self.end_headers()
-                self.wfile.write(
-                    b'{"user":{"name":"admin"},"auth_token":{"token":"abc","expires_at":"2044-04-01T00:00:00.000Z"}}'
-                )
+            self.handle_endpoint('phone_number_token', self.post_phone_number_token, post_data)
+        elif self.path == '/api/phone_access/session_bootstrap':
+            self.handle_endpoint('session_bootstrap', self.post_session_bootstrap, post_data)
         elif self.path == '/api/phone_access/verify_pin':
-            self.send_response(http.HTTPStatus.OK)
+            self.handle_endpoint('verify_pin', self.post_verify_pin, post_data)
+        elif match := door_action_re.fullmatch(self.path):
+            self.handle_endpoint('door_action', self.post_door_action, *match.groups())
+        else:
+            raise NotImplementedError(f"POST {self.path!r} is not implemented")
+
+    def handle_endpoint(self, endpoint, respond, *args):
+        """
+        Count the request, then answer it with ``respond`` after the configured latency or inject a failure.
+        """
+        self.server.count(self.server.request_counts, endpoint)
+        if self.server.concurrency:
+            self.server.concurrency.acquire()
+        try:
+            latency = self.server.for_endpoint(self.server.latencies, endpoint)
+            if latency:
+                time.sleep(latency())
+
+            rate, mode = self.server.for_endpoint(self.server.failures, endpoint) or (0, None)
+            if random.random() < rate:
+                self.server.count(self.server.failure_counts, endpoint)
+                self.inject_failure(mode)
+            else:
+                respond(*args)
+        finally:
+            if self.server.concurrency:
+                self.server.concurrency.release()
+
+    def inject_failure(self, mode):
+        if mode == 'timeout':
+            time.sleep(self.server.hang)
+            self.close_connection = True
+        elif mode == 'reset':
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+        else:
+            self.send_json(int(mode), {'error': 'injected failure'})
+
+    def send_json(self, status, data):
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(json.dumps(data, indent=4).encode('utf-8'))
+
+    def user_index(self):
+        token = self.headers.get('Authorization', '').rpartition(' ')[2]
+        for user_index in range(self.server.users):
+            if user_token(user_index) == token:
+                return user_index
+        return 0
+
+    def get_doors(self):
+        self.send_json(http.HTTPStatus.OK, self.server.doors)
+
+    def get_current_user(self):
+        self.send_json(http.HTTPStatus.OK, make_user(self.user_index()))
+
+    def phone_number_user_index(self, post_data):
+        phone_number = urllib.parse.parse_qs(post_data.decode('utf-8')).get('phone_number', [''])[0]
+        return int(re.sub(r'\D', '', phone_number) or 0) % self.server.users
+
+    def post_phone_number_token(self, post_data):
+        if post_data.endswith(b'880000000'):  # hack to have a not-found result
+            self.send_response(http.HTTPStatus.NOT_FOUND)
             self.end_headers()
-            self.wfile.write(b'{"pin": "%s"}' % (b'valid' if post_data == b'pin=123456' else b'invalid'))
-        elif door_action_re.fullmatch(self.path):
-            self.send_response(http.HTTPStatus.NO_CONTENT)
+            self.wfile.write(b'{}')  # the response body is not inline with the backend
+        else:
+            user_index = self.phone_number_user_index(post_data)
+            self.send_response(http.HTTPStatus.OK)
             self.end_headers()
+            self.wfile.write(json.dumps({
+                'user': {'name': 'admin'},
+                'auth_token': {'token': user_token(user_index), 'expires_at': '2044-04-01T00:00:00.000Z'},
+            }).encode('utf-8'))
+
+    def post_session_bootstrap(self, post_data):
+        """
+        phone_number_token, current_user and doors in one response - unknown numbers get null for all of them.
+        """
+        if not self.server.session_bootstrap:
+            self.send_json(http.HTTPStatus.NOT_FOUND, {})
+        elif post_data.endswith(b'880000000'):  # hack to have a not-found result
+            self.send_json(http.HTTPStatus.OK, {'auth_token': None, 'user': None, 'doors': None})
         else:
-            raise NotImplementedError(f"POST {self.path!r} is not implemented")
+            user_index = self.phone_number_user_index(post_data)
+            self.send_json(http.HTTPStatus.OK, {
+                'auth_token': {'token': user_token(user_index), 'expires_at': '2044-04-01T00:00:00.000Z'},
+                'user': make_user(user_index),
+                'doors': self.server.doors,
+            })
+
+    def post_verify_pin(self, post_data):
+        self.send_response(http.HTTPStatus.OK)
+        self.end_headers()
+        self.wfile.write(b'{"pin": "%s"}' % (b'valid' if post_data == b'pin=123456' else b'invalid'))
+
+    def get_door_statuses(self):
+        with self.server.door_status_changed:
+            statuses = [{'id': door_id, 'status': status} for door_id, status in self.server.door_statuses.items()]
+        self.send_json(http.HTTPStatus.OK, statuses)
+
+    def get_door_status_stream(self):
+        """
+        A snapshot of the door statuses followed by their changes, with a heartbeat comment when nothing changes.
+        """
+        if not self.server.door_status_stream:
+            self.send_json(http.HTTPStatus.NOT_FOUND, {})
+            return
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        events = self.server.door_status_events
+        with self.server.door_status_changed:
+            snapshot = [{'id': door_id, 'status': status} for door_id, status in self.server.door_statuses.items()]
+            position = len(events)
+        try:
+            self.wfile.write(f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            while True:
+                with self.server.door_status_changed:
+                    self.server.door_status_changed.wait_for(lambda: len(events) > position, self.server.heartbeat)
+                    new_events, position = events[position:], len(events)
+                message = ''.join(f"data: {json.dumps(event)}\n\n" for event in new_events) or ': heartbeat\n\n'
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def post_door_action(self, door_id, action):
+        """
+        Door actions with an already performed ``Idempotency-Key`` (hedged and retried requests) are not performed
+        again, like in portier. The status of a lockable door changes ``--status-delay`` seconds after the action.
+        """
+        key = self.headers.get('Idempotency-Key')
+        with self.server.stats_lock:
+            performed = key is None or key not in self.server.door_action_keys
+            if performed:
+                self.server.door_action_keys.add(key)
+                self.server.door_action_counts['performed'] += 1
+            else:
+                self.server.door_action_counts['deduplicated'] += 1
+        if performed and door_id in self.server.door_statuses:
+            status = 'locked' if action == 'lock' else 'unlocked'
+            if self.server.status_delay:
+                threading.Timer(self.server.status_delay, self.server.set_door_status, (door_id, status)).start()
+            else:
+                self.server.set_door_status(door_id, status)
+        self.send_response(http.HTTPStatus.NO_CONTENT)
+        self.end_headers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock http server of {fauna|portier}.initlab.org's door API")
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default %(default)s)')
+    parser.add_argument('--latency', type=endpoint_option(parse_latency), action='append', default=[],
+                        metavar='ENDPOINT=DISTRIBUTION',
+                        help='response latency in ms: fixed:MS, uniform:MIN:MAX, normal:MEAN:STDDEV or exp:MEAN')
+    parser.add_argument('--fail', type=endpoint_option(parse_failure), action='append', default=[],
+                        metavar='ENDPOINT=RATE:MODE',
+                        help='fail this fraction of the requests with a http status code, timeout or reset')
+    parser.add_argument('--hang', type=float, default=60,
+                        help='seconds a timeout failure keeps the connection open (default %(default)s)')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='requests handled at the same time, the rest wait (default unlimited)')
+    parser.add_argument('--doors', type=int, default=len(DOORS), help='number of doors (default %(default)s)')
+    parser.add_argument('--users', type=int, default=1,
+                        help='number of users, phone numbers are mapped to them (default %(default)s)')
+    parser.add_argument('--no-session-bootstrap', dest='session_bootstrap', action='store_false',
+                        help='answer session_bootstrap with 404, like a backend without the endpoint')
+    parser.add_argument('--no-door-status-stream', dest='door_status_stream', action='store_false',
+                        help='answer doors/statuses/stream with 404, so the door statuses are polled')
+    parser.add_argument('--unlocked', action='append', default=[], metavar='DOOR_ID',
+                        help='a lockable door which starts unlocked (the others start locked)')
+    parser.add_argument('--status-delay', type=float, default=0,
+                        help='seconds after a door action when the status of the door changes (default %(default)s)')
+    parser.add_argument('--heartbeat', type=float, default=15,
+                        help='seconds between the heartbeats of the door status stream (default %(default)s)')
+    options = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # print the stats on kill too
+    server_address = (options.host, options.port)
+    with FaunaServer(server_address, options) as httpd:
+        print(f"serving at http://{server_address[0]}:{server_address[1]}", flush=True)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print('requests:', json.dumps(httpd.stats()))
 
 
 if __name__ == '__main__':
-    server_address = ("127.0.0.1", PORT)
-    with socketserver.TCPServer(server_address, FaunaHandler) as httpd:
-        print(f"serving at http://{server_address[0]}:{server_address[1]}")
-        httpd.serve_forever()
+    main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+"""
+Concurrent call benchmark of door_ivr.py against backend_mock.py.
+
+Replays the AGI test scripts as many concurrent simulated channels, either as one door_ivr.py process per call
+(like Asterisk's AGI) or against one of the FastAGI servers, and reports the calls per second, the time to ANSWER and
+to the first prompt, the import time of door_ivr.py and the per-stage latency percentiles recorded by the door managers
+(see ``[metrics] json_log``).
+
+Written without any dependencies besides the ones of door_ivr.py and runs fully offline.
+
+Usage:
+    ./benchmark.py --mode=process --calls=50 --concurrency=10
+    ./benchmark.py --mode=process --calls=20 --concurrency=1 --mock-port=3010 --mock-args='--latency=*=fixed:20' \
+        --repeat=3 --tolerance=0.5 --min-regression=0.02 --compare-baseline=benchmark-startup-baseline.json  # CI
+    ./benchmark.py --mode=fastagi --calls=200 --concurrency=50 --mock-args='--latency=*=normal:40:15'
+    ./benchmark.py --mode=async --calls=500 --concurrency=100 --save-baseline=baseline-async.json
+    ./benchmark.py --mode=async --calls=500 --concurrency=100 --compare-baseline=baseline-async.json
+    ./benchmark.py --mode=async --calls=200 --concurrency=20 --mock-args='--latency=*=fixed:20' --repeat=3 \
+        --tolerance=0.5 --min-regression=0.02 --compare-baseline=benchmark-baseline.json  # like the CI
+"""
+
+import argparse
+import concurrent.futures
+import configparser
+import json
+import os
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from pathlib import Path
+
+TESTS_DIR = Path(__file__).resolve().parent
+DOOR_IVR_DIR = TESTS_DIR.parent
+
+# script -> (handler, --phone)
+SCENARIOS = {
+    'agi-test.txt': ('external', None),
+    'agi-unknown-number.txt': ('external', None),
+    'agi-payphone-test.txt': ('payphone', None),
+    'agi-internal-test.txt': ('internal', None),
+    'agi-in-call-test.txt': ('in-call', '1'),
+}
+
+SERVER_COMMANDS = {
+    'fastagi': [sys.executable, str(DOOR_IVR_DIR / 'door_ivr.py'), '--serve'],
+    'async': [sys.executable, str(DOOR_IVR_DIR / 'door_ivr_async.py')],
+}
+
+# a regression is reported when a value gets worse by more than the tolerance and by more than this many seconds
+# (by default - see --min-regression)
+REGRESSION_MIN_SECONDS = 0.005
+# the values of the summaries of best_of() - lower is better
+SUMMARY_VALUES = ('p50', 'p90', 'p99', 'max')
+# the prompts of failed calls - none of the scripts ends in them unless backend_mock.py injects failures
+ERROR_PROMPTS = {'action_unsuccessful', 'insufficient_permissions', 'lock_failed', 'service_unavailable'}
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile, None for no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(percent / 100 * len(values) + 0.5) - 1))]
+
+
+def load_script(name):
+    return re.sub('#.*', '', (TESTS_DIR / name).read_text())
+
+
+def fastagi_script(script, handler, phone):
+    headers = f"agi_network: yes\nagi_network_script: {handler}\n"
+    if phone:
+        headers += f"agi_arg_1: {phone}\n"
+    return headers + script
+
+
+def is_prompt(line):
+    return line.startswith('STREAM FILE') or line.startswith('SAY DIGITS')
+
+
+class CallTimer:
+    """
+    Seconds from the start of a call to its ANSWER command, first prompt and end, and the error prompt it played if any.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.answered_at = None
+        self.first_prompt_at = None
+        self.error_prompt = None
+
+    def command(self, line):
+        if self.answered_at is None and line.startswith('ANSWER'):
+            self.answered_at = time.monotonic()
+        if is_prompt(line):
+            if self.first_prompt_at is None:
+                self.first_prompt_at = time.monotonic()
+            if line.startswith('STREAM FILE') and Path(line.split()[2]).name in ERROR_PROMPTS:
+                self.error_prompt = Path(line.split()[2]).name
+
+    def result(self):
+        return {
+            'time_to_answer': self.answered_at and self.answered_at - self.started_at,
+            'time_to_first_prompt': self.first_prompt_at and self.first_prompt_at - self.started_at,
+            'call_duration': time.monotonic() - self.started_at,
+            'error_prompt': self.error_prompt,
+        }
+
+
+def run_process_channel(script, handler, phone, config_filename):
+    """
+    Run one door_ivr.py process per call, like Asterisk's AGI().
+    """
+    command = [sys.executable, str(DOOR_IVR_DIR / 'door_ivr.py'), f'--handler={handler}', f'--config={config_filename}']
+    if phone:
+        command.append(f'--phone={phone}')
+    timer = CallTimer()
+    with subprocess.Popen(command, cwd=TESTS_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, text=True) as process:
+        process.stdin.write(script)
+        process.stdin.close()
+        for line in process.stdout:
+            timer.command(line)
+    return timer.result()
+
+
+def run_fastagi_channel(script, port):
+    """
+    Run one call against a FastAGI server.
+    """
+    timer = CallTimer()
+    with socket.create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall(script.encode('utf-8'))
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile('r', encoding='utf-8') as commands:
+            try:
+                for line in commands:
+                    timer.command(line)
+            except ConnectionResetError:
+                pass  # the call ended before reading the whole script, e.g. on an injected backend failure
+    return timer.result()
+
+
+def measure_import_time(runs):
+    """
+    Seconds ``import door_ivr`` takes in a new interpreter (``python -X importtime``), once per run.
+    """
+    import_times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import door_ivr'], cwd=DOOR_IVR_DIR,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True).stderr
+        # import time: self [us] | cumulative | imported package
+        cumulative = next(line for line in output.splitlines() if line.endswith('| door_ivr')).split('|')[1]
+        import_times.append(int(cumulative) / 1_000_000)
+    return import_times
+
+
+def wait_for_port(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def read_backend_stats(port):
+    """
+    Requests (and injected failures) per endpoint served by backend_mock.py so far.
+    """
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return json.load(response)
+
+
+def count_values(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def subtract_counts(after, before):
+    return {key: count - before.get(key, 0) for key, count in after.items() if count - before.get(key, 0)}
+
+
+def read_stage_timings(json_log):
+    stages = {}
+    with open(json_log) as json_log_file:
+        for line in json_log_file:
+            for stage in json.loads(line)['stages']:
+                stages.setdefault(stage['stage'], []).append(stage['seconds'])
+    return stages
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def run_benchmark(args):
+    config = configparser.ConfigParser()
+    config.read(DOOR_IVR_DIR / 'door_ivr.test.conf')
+    for option in ('auth_api_url', 'door_api_url'):
+        url = urllib.parse.urlsplit(config['backend'][option])
+        config['backend'][option] = url._replace(netloc=f'127.0.0.1:{args.mock_port}').geturl()
+    if not config.has_section('metrics'):
+        config.add_section('metrics')
+    config['metrics']['prometheus_port'] = ''
+    if args.http_client:
+        config['http']['client'] = args.http_client
+    if args.session_bootstrap:
+        config['backend']['session_bootstrap'] = 'true'
+    config['cache']['store'] = args.cache_store
+
+    with tempfile.TemporaryDirectory(prefix='door-ivr-benchmark-') as temp_dir:
+        config['cache']['path'] = os.path.join(temp_dir, 'cache.sqlite3')
+        json_log = os.path.join(temp_dir, 'calls.jsonl')
+        config['metrics']['json_log'] = json_log
+        config_filename = os.path.join(temp_dir, 'door_ivr.conf')
+        with open(config_filename, 'w') as config_file:
+            config.write(config_file)
+
+        processes = []
+        try:
+            if not args.no_mock:
+                processes.append(subprocess.Popen(
+                    [sys.executable, str(TESTS_DIR / 'backend_mock.py'), f'--port={args.mock_port}']
+                    + shlex.split(args.mock_args),
+                    cwd=TESTS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                wait_for_port(args.mock_port, processes[-1])
+            if args.mode != 'process':
+                processes.append(subprocess.Popen(
+                    SERVER_COMMANDS[args.mode] + [f'--port={args.port}', f'--config={config_filename}'],
+                    cwd=TESTS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                wait_for_port(args.port, processes[-1])
+
+            calls = []
+            for call_number in range(args.calls):
+                script_name = args.scripts[call_number % len(args.scripts)]
+                handler, phone = SCENARIOS[script_name]
+                # every call is a channel of its own, so the in-call feature key presses are not debounced
+                script = re.sub(r'^(agi_channel: .+-).*$', rf'\g<1>{call_number:08x}', load_script(script_name),
+                                flags=re.MULTILINE)
+                if args.mode == 'process':
+                    calls.append((run_process_channel, script, handler, phone, config_filename))
+                else:
+                    calls.append((run_fastagi_channel, fastagi_script(script, handler, phone), args.port))
+
+            backend_stats_before = read_backend_stats(args.mock_port)
+            started_at = time.monotonic()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(lambda call: call[0](*call[1:]), calls))
+            duration = time.monotonic() - started_at
+            backend_stats = read_backend_stats(args.mock_port)
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+                process.wait()
+
+        stages = read_stage_timings(json_log) if os.path.exists(json_log) else {}
+
+    def summarize_results(key):
+        return summarize([result[key] for result in results if result[key] is not None])
+
+    return {
+        'mode': args.mode,
+        'calls': args.calls,
+        'concurrency': args.concurrency,
+        'scripts': args.scripts,
+        'duration': duration,
+        'calls_per_second': args.calls / duration,
+        'import_time': summarize(measure_import_time(args.import_runs) if args.mode == 'process' else []),
+        'time_to_answer': summarize_results('time_to_answer'),
+        'time_to_first_prompt': summarize_results('time_to_first_prompt'),
+        'call_duration': summarize_results('call_duration'),
+        'stages': {stage: summarize(values) for stage, values in sorted(stages.items())},
+        'error_prompts': count_values(result['error_prompt'] for result in results if result['error_prompt']),
+        'backend_requests': subtract_counts(backend_stats['requests'], backend_stats_before['requests']),
+        'backend_failures': subtract_counts(backend_stats['failures'], backend_stats_before['failures']),
+        'door_actions': subtract_counts(backend_stats['door_actions'], backend_stats_before['door_actions']),
+    }
+
+
+def best_of(reports):
+    """
+    Combine the reports of repeated runs into one with the best result of every value - the highest calls per second
+    and the lowest latencies - so a run slowed down by a noisy machine doesn't look like a regression.
+    """
+    best = dict(reports[0], stages=dict(reports[0]['stages']))
+    best['duration'] = min(report['duration'] for report in reports)
+    best['calls_per_second'] = max(report['calls_per_second'] for report in reports)
+
+    def best_summary(summaries):
+        return dict(summaries[0], **{
+            key: min((summary[key] for summary in summaries if summary[key] is not None), default=None)
+            for key in SUMMARY_VALUES
+        })
+
+    for name in ('import_time', 'time_to_answer', 'time_to_first_prompt', 'call_duration'):
+        best[name] = best_summary([report[name] for report in reports])
+    for stage in {stage for report in reports for stage in report['stages']}:
+        best['stages'][stage] = best_summary([report['stages'][stage] for report in reports
+                                              if stage in report['stages']])
+    best['stages'] = dict(sorted(best['stages'].items()))
+    return best
+
+
+def find_call_problems(report):
+    """
+    Return why the calls of a run don't measure what they should - none of them reached backend_mock.py (the backend
+    URLs point elsewhere) or some ended in an error prompt although the mock injected no failures.
+    """
+    problems = []
+    if not report['backend_requests']:
+        problems.append('no backend requests reached backend_mock.py')
+    if report['error_prompts'] and not report['backend_failures']:
+        problems.append('calls ended in error prompts: '
+                        + ', '.join(f"{prompt}={count}" for prompt, count in report['error_prompts'].items()))
+    return problems
+
+
+def find_regressions(report, baseline, tolerance, min_seconds=REGRESSION_MIN_SECONDS):
+    regressions = []
+    if report['calls_per_second'] < baseline['calls_per_second'] * (1 - tolerance):
+        regressions.append(f"calls_per_second {baseline['calls_per_second']:.2f} -> {report['calls_per_second']:.2f}")
+
+    latencies = [
+        (name, report[name], baseline[name])
+        for name in ('import_time', 'time_to_answer', 'time_to_first_prompt') if name in baseline
+    ]
+    latencies += [
+        (f"stage {stage}", summary, baseline['stages'][stage])
+        for stage, summary in report['stages'].items() if stage in baseline['stages']
+    ]
+    for name, summary, baseline_summary in latencies:
+        for key in ('p50', 'p99'):
+            value, baseline_value = summary[key], baseline_summary[key]
+            if value is None or baseline_value is None:
+                continue
+            if value > baseline_value * (1 + tolerance) and value - baseline_value > min_seconds:
+                regressions.append(f"{name} {key} {baseline_value * 1000:.1f}ms -> {value * 1000:.1f}ms")
+    return regressions
+
+
+def print_report(report):
+    def milliseconds(value):
+        return '-' if value is None else f"{value * 1000:.1f}"
+
+    print(f"mode={report['mode']} calls={report['calls']} concurrency={report['concurrency']} "
+          f"duration={report['duration']:.2f}s calls/s={report['calls_per_second']:.2f}")
+    print(f"{'stage':<30} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [
+        (name, report[name]) for name in ('import_time', 'time_to_answer', 'time_to_first_prompt', 'call_duration')
+        if report[name]['count']
+    ]
+    rows += list(report['stages'].items())
+    for name, summary in rows:
+        print(f"{name:<30} {summary['count']:>7} {milliseconds(summary['p50']):>9} {milliseconds(summary['p90']):>9} "
+              f"{milliseconds(summary['p99']):>9} {milliseconds(summary['max']):>9}")
+    print('backend requests:',
+          ', '.join(f"{endpoint}={count}" for endpoint, count in report['backend_requests'].items()))
+    if report['backend_failures']:
+        print('backend injected failures:',
+              ', '.join(f"{endpoint}={count}" for endpoint, count in report['backend_failures'].items()))
+    if report['door_actions']:
+        print('door actions:', ', '.join(f"{result}={count}" for result, count in report['door_actions'].items()))
+    if report['error_prompts']:
+        print('error prompts:', ', '.join(f"{prompt}={count}" for prompt, count in report['error_prompts'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent call benchmark of door_ivr.py against backend_mock.py')
+    parser.add_argument('--mode', choices=['process'] + list(SERVER_COMMANDS), default='process',
+                        help='one door_ivr.py process per call, the threaded or the asyncio FastAGI server')
+    parser.add_argument('--calls', type=int, default=50, help='number of calls (default %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='number of simultaneous channels (default %(default)s)')
+    parser.add_argument('--scripts', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='AGI scripts to replay round-robin (default all)')
+    parser.add_argument('--http-client', choices=['requests', 'http.client'],
+                        help='[http] client of door_ivr.py (default from door_ivr.test.conf)')
+    parser.add_argument('--session-bootstrap', action='store_true',
+                        help='look up the callers with a single session_bootstrap request - see [backend]')
+    parser.add_argument('--cache-store', choices=['memory', 'sqlite'], default='memory',
+                        help='where the caches are kept - see [cache] store (default %(default)s)')
+    parser.add_argument('--import-runs', type=int, default=10,
+                        help='times to measure the import time of door_ivr.py in process mode (default %(default)s)')
+    parser.add_argument('--port', type=int, default=4574, help='FastAGI server port (default %(default)s)')
+    parser.add_argument('--mock-port', type=int, default=3002, help='backend_mock.py port (default %(default)s)')
+    parser.add_argument('--no-mock', action='store_true', help='use an already running backend_mock.py')
+    parser.add_argument('--mock-args', default='',
+                        help="backend_mock.py options, "
+                             "e.g. --mock-args='--latency=*=normal:40:15 --fail=doors=0.1:503'")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run the benchmark this many times and keep the best result of every value '
+                             '(default %(default)s)')
+    parser.add_argument('--save-baseline', help='store the results as a baseline in this JSON file')
+    parser.add_argument('--compare-baseline', help='compare the results with the baseline in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown compared to the baseline (default %(default)s)')
+    parser.add_argument('--min-regression', type=float, default=REGRESSION_MIN_SECONDS,
+                        help='seconds a latency must get slower by to be a regression, besides the tolerance '
+                             '(default %(default)s)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    reports = [run_benchmark(args) for _ in range(args.repeat)]
+    report = best_of(reports)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+    problems = [problem for run_report in reports for problem in find_call_problems(run_report)]
+    for problem in problems:
+        print('ERROR:', problem)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=4)
+
+    if args.compare_baseline:
+        with open(args.compare_baseline) as baseline_file:
+            regressions = find_regressions(report, json.load(baseline_file), args.tolerance, args.min_regression)
+        for regression in regressions:
+            print('REGRESSION:', regression)
+        if regressions:
+            sys.exit(1)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for Asterisk's ``file convert`` in assets_test.py, converting between the 8 kHz 16 bit mono sln and wav of
+the fixtures.
+
+Usage:
+    ./convert.py source.wav target.sln
+"""
+
+import sys
+import wave
+
+
+def main():
+    source, target = sys.argv[1:]
+    if source.endswith('.wav'):
+        with wave.open(source, 'rb') as source_file:
+            frames = source_file.readframes(source_file.getnframes())
+    else:
+        with open(source, 'rb') as source_file:
+            frames = source_file.read()
+
+    if target.endswith('.wav'):
+        with wave.open(target, 'wb') as target_file:
+            target_file.setnchannels(1)
+            target_file.setsampwidth(2)
+            target_file.setframerate(8000)
+            target_file.writeframes(frames)
+    else:
+        with open(target, 'wb') as target_file:
+            target_file.write(frames)
+
+
+if __name__ == '__main__':
+    main()
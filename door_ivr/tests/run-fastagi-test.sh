@@ -0,0 +1,27 @@
+#/bin/bash
+
+# Interact with door_ivr.py running as a FastAGI server
+# Usage:
+#   ./run-fastagi-test.sh agi-fastagi-test.txt
+#   FASTAGI_SERVER=../door_ivr_async.py ./run-fastagi-test.sh agi-fastagi-test.txt  # asyncio server
+#   CONFIG=door_ivr.other.conf ./run-fastagi-test.sh agi-fastagi-test.txt  # another config (default ../door_ivr.test.conf)
+# The AGI commands sent back by the server are printed on stdout.
+
+set +o pipefail -e
+
+PORT=${PORT:-4573}
+FASTAGI_SERVER=${FASTAGI_SERVER:-../door_ivr.py --serve}
+
+python $FASTAGI_SERVER --port=$PORT --config=${CONFIG:-../door_ivr.test.conf} 2>/dev/null &
+SERVER_PID=$!
+trap 'kill $SERVER_PID' EXIT
+sleep 1
+
+(cat $@ | sed 's/#.*//') | python -c "
+import socket, sys
+with socket.create_connection(('127.0.0.1', $PORT)) as connection:
+    connection.sendall(sys.stdin.buffer.read())
+    connection.shutdown(socket.SHUT_WR)
+    while data := connection.recv(4096):
+        sys.stdout.buffer.write(data)
+"
@@ -5,7 +5,9 @@
 #   ./run-test.sh -    # for stdin
 #   ./run-test.sh test-file.txt
 #   ./run-test.sh test-file.txt -  # for test file and stdin
+#   HANDLER=in-call PHONE=1 ./run-test.sh agi-in-call-test.txt  # for other handlers (default external)
+#   CONFIG=door_ivr.other.conf ./run-test.sh agi-test.txt  # for another config (default ../door_ivr.test.conf)
 
 set +o pipefail -e
 
-(cat $@ | sed 's/#.*//') | python ../door_ivr.py --handler=external --config=../door_ivr.test.conf
+(cat $@ | sed 's/#.*//') | python ../door_ivr.py --handler=${HANDLER:-external} ${PHONE:+--phone=$PHONE} --config=${CONFIG:-../door_ivr.test.conf}